@@ -2,6 +2,14 @@
 
 cd ~/chris/boutique
 
+pkill -f "gunicorn.*app:app"
 pkill -f app.py
 
-python app.py
+# Several workers so the registers don't queue behind each other;
+# falls back to the development server if gunicorn isn't installed
+if command -v gunicorn > /dev/null 2>&1; then
+    gunicorn -c gunicorn.conf.py app:app
+else
+    echo "⚠️ gunicorn not found (pip install gunicorn); using the development server"
+    python app.py
+fi
@@ -0,0 +1,25 @@
+#!/data/data/com.termux/files/usr/bin/bash
+# Put freshly pulled code live without dropping requests: start a new
+# gunicorn master alongside the old one, then let the old one finish its
+# requests and exit.
+
+cd ~/chris/boutique || exit 1
+
+[ -f gunicorn.pid ] || { echo "gunicorn is not running"; exit 1; }
+OLD=$(cat gunicorn.pid)
+
+kill -USR2 "$OLD"
+# The new master writes gunicorn.pid.2 once it is up, and takes over
+# gunicorn.pid when the old one has gone
+for _ in $(seq 1 30); do
+    [ -f gunicorn.pid.2 ] && break
+    sleep 1
+done
+if [ ! -f gunicorn.pid.2 ]; then
+    echo "❌ New server did not start; still running the old code"
+    exit 1
+fi
+NEW=$(cat gunicorn.pid.2)
+
+kill -TERM "$OLD"
+echo "✅ Reloaded: $NEW replaces $OLD"
@@ -9,6 +9,35 @@ cd "$REPO_DIR" || { echo "❌ Error: Cannot access $REPO_DIR"; exit 1; }
 # Ensure it's a Git repo
 git rev-parse --is-inside-work-tree > /dev/null 2>&1 || { echo "❌ Not a Git repository"; exit 1; }
 
+# git pull may replace the DB file, and SQLite's -wal/-shm files go by name:
+# a server still holding the old file would mix its WAL into the pulled one.
+# Stop it for the update and start it again at the end.
+RESTART=0
+if [ -f gunicorn.pid ]; then
+    PID=$(cat gunicorn.pid)
+    kill -TERM "$PID"
+    # gunicorn lets requests in flight finish (graceful_timeout) before exiting
+    for _ in $(seq 1 30); do
+        kill -0 "$PID" 2> /dev/null || break
+        sleep 1
+    done
+    if kill -0 "$PID" 2> /dev/null; then
+        echo "❌ Server did not stop; nothing was updated"
+        exit 1
+    fi
+    RESTART=1
+    echo "⏸️ Stopped the server"
+elif pgrep -f "python app.py" > /dev/null; then
+    echo "❌ Stop the server (python app.py) before updating"
+    exit 1
+fi
+
+# Fold the WAL back into the main DB file so the copy and the commit are complete
+if [ -f "$DB_PATH" ]; then
+    python -c "import sqlite3, sys; sqlite3.connect(sys.argv[1]).execute('PRAGMA wal_checkpoint(TRUNCATE)')" "$DB_PATH" \
+        && echo "✅ Checkpointed WAL"
+fi
+
 # Backup the database
 if [ -f "$DB_PATH" ]; then
     cp "$DB_PATH" "$DB_BACKUP"
@@ -44,3 +73,9 @@ if git stash list | grep -q "Pre-pull stash"; then
 fi
 
 echo "✅ Done: DB is pushed, pull complete, and conflicts avoided."
+
+# Serve the pulled code and DB
+if [ "$RESTART" = 1 ]; then
+    nohup gunicorn -c gunicorn.conf.py app:app >> nohup.out 2>&1 &
+    echo "▶️ Server started again"
+fi
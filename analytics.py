@@ -0,0 +1,148 @@
+"""Sales reports computed in SQL from the rollup tables.
+
+Every report reads the day (or hour) buckets of reports.py for an inclusive
+range of UTC days, so a year of trading is a few thousand rollup rows rather
+than the raw order log. Ranking, shares and running totals come from window
+functions. Hour-of-day and weekday are shifted to the server's local time,
+which is the shop's.
+
+Each report is report(conn, start, end, limit) -> list of dicts, start/end
+as 'YYYY-MM-DD'; REPORTS maps the names used in the URL to them.
+"""
+
+WEEKDAYS = ("domingo", "lunes", "martes", "miércoles", "jueves", "viernes", "sábado")
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 500
+
+
+def _rows(cursor):
+    columns = [col[0] for col in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+def top_products(conn, start, end, limit=DEFAULT_LIMIT):
+    return _rows(conn.execute(
+        """
+        WITH totals AS (
+            SELECT product_id, MAX(product_name) AS product_name, MAX(category_name) AS category_name,
+                   SUM(quantity) AS quantity, SUM(revenue) AS revenue
+            FROM sales_by_product
+            WHERE grain = 'day' AND bucket BETWEEN :start AND :end
+            GROUP BY product_id
+        )
+        SELECT RANK() OVER (ORDER BY revenue DESC) AS rank,
+               product_id, product_name, category_name, quantity, revenue,
+               ROUND(100.0 * revenue / NULLIF(SUM(revenue) OVER (), 0), 1) AS revenue_share,
+               ROUND(100.0 * SUM(revenue) OVER (ORDER BY revenue DESC, product_id ROWS UNBOUNDED PRECEDING)
+                     / NULLIF(SUM(revenue) OVER (), 0), 1) AS cumulative_share
+        FROM totals
+        ORDER BY revenue DESC, product_id
+        LIMIT :limit
+        """,
+        {"start": start, "end": end, "limit": limit},
+    ))
+
+
+def categories(conn, start, end, limit=None):
+    return _rows(conn.execute(
+        """
+        SELECT RANK() OVER (ORDER BY SUM(revenue) DESC) AS rank,
+               category_name, SUM(quantity) AS quantity, SUM(revenue) AS revenue,
+               SUM(gross) - SUM(revenue) AS discount_given,
+               ROUND(100.0 * SUM(revenue) / NULLIF(SUM(SUM(revenue)) OVER (), 0), 1) AS revenue_share
+        FROM sales_by_category
+        WHERE grain = 'day' AND bucket BETWEEN :start AND :end
+        GROUP BY category_name
+        ORDER BY revenue DESC, category_name
+        """,
+        {"start": start, "end": end},
+    ))
+
+
+def hours(conn, start, end, limit=None):
+    return _rows(conn.execute(
+        """
+        SELECT CAST(strftime('%H', bucket, 'localtime') AS INTEGER) AS hour,
+               SUM(orders) AS orders, SUM(quantity) AS quantity, SUM(revenue) AS revenue,
+               ROUND(1.0 * SUM(revenue) / NULLIF(SUM(orders), 0), 1) AS average_ticket,
+               ROUND(100.0 * SUM(revenue) / NULLIF(SUM(SUM(revenue)) OVER (), 0), 1) AS revenue_share
+        FROM sales_by_period
+        WHERE grain = 'hour' AND bucket >= :start AND bucket < date(:end, '+1 day')
+        GROUP BY hour
+        ORDER BY hour
+        """,
+        {"start": start, "end": end},
+    ))
+
+
+def weekdays(conn, start, end, limit=None):
+    rows = _rows(conn.execute(
+        """
+        SELECT CAST(strftime('%w', bucket, 'localtime') AS INTEGER) AS weekday,
+               COUNT(DISTINCT date(bucket, 'localtime')) AS trading_days,
+               SUM(orders) AS orders, SUM(revenue) AS revenue,
+               ROUND(1.0 * SUM(revenue) / COUNT(DISTINCT date(bucket, 'localtime')), 1) AS revenue_per_day,
+               ROUND(100.0 * SUM(revenue) / NULLIF(SUM(SUM(revenue)) OVER (), 0), 1) AS revenue_share
+        FROM sales_by_period
+        WHERE grain = 'hour' AND bucket >= :start AND bucket < date(:end, '+1 day')
+        GROUP BY weekday
+        ORDER BY weekday
+        """,
+        {"start": start, "end": end},
+    ))
+    for row in rows:
+        row["weekday_name"] = WEEKDAYS[row["weekday"]]
+    return rows
+
+
+def discounts(conn, start, end, limit=None):
+    # gross is the lines at list price; the difference is what discounts cost
+    return _rows(conn.execute(
+        """
+        SELECT discount_percent, SUM(lines) AS lines, SUM(quantity) AS quantity,
+               SUM(gross) AS gross, SUM(revenue) AS revenue, SUM(gross) - SUM(revenue) AS discount_given,
+               ROUND(100.0 * SUM(quantity) / NULLIF(SUM(SUM(quantity)) OVER (), 0), 1) AS quantity_share,
+               ROUND(100.0 * (SUM(gross) - SUM(revenue)) / NULLIF(SUM(SUM(gross) - SUM(revenue)) OVER (), 0), 1) AS discount_share
+        FROM sales_by_discount
+        WHERE grain = 'day' AND bucket BETWEEN :start AND :end
+        GROUP BY discount_percent
+        ORDER BY discount_percent
+        """,
+        {"start": start, "end": end},
+    ))
+
+
+def daily(conn, start, end, limit=None):
+    # Every day of the range, sales or not, with running totals and a
+    # trailing 7-day average
+    return _rows(conn.execute(
+        """
+        WITH RECURSIVE days(day) AS (
+            SELECT :start
+            UNION ALL
+            SELECT date(day, '+1 day') FROM days WHERE day < :end
+        ),
+        sales AS (
+            SELECT days.day, COALESCE(p.orders, 0) AS orders, COALESCE(p.revenue, 0) AS revenue
+            FROM days LEFT JOIN sales_by_period p ON p.grain = 'day' AND p.bucket = days.day
+        )
+        SELECT day, orders, revenue,
+               SUM(orders) OVER running AS running_orders,
+               SUM(revenue) OVER running AS running_revenue,
+               ROUND(AVG(revenue) OVER (ORDER BY day ROWS 6 PRECEDING), 1) AS revenue_7day_average
+        FROM sales
+        WINDOW running AS (ORDER BY day ROWS UNBOUNDED PRECEDING)
+        ORDER BY day
+        """,
+        {"start": start, "end": end},
+    ))
+
+
+REPORTS = {
+    "top-products": top_products,
+    "categories": categories,
+    "hours": hours,
+    "weekdays": weekdays,
+    "discounts": discounts,
+    "daily": daily,
+}
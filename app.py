@@ -1,7 +1,8 @@
-from flask import Flask, render_template, session, render_template_string, request, redirect, flash, get_flashed_messages
-import sqlite3
-from datetime import date, timedelta, datetime
+from flask import Flask, render_template, session, render_template_string, request, redirect, flash, get_flashed_messages, jsonify, send_from_directory, abort, Response, stream_with_context
+from datetime import timedelta, datetime, timezone
 import re
+import csv
+import io
 import random
 import string
 from pathlib import Path
@@ -10,26 +11,72 @@ from werkzeug.utils import secure_filename
 from flask import url_for
 import uuid
 import json
+import hashlib
+import sqlite3
+from contextlib import closing
+
+import click
+
+import analytics
+import catalog
+import export
+import db
+import idempotency
+import images
+import metrics
+import migrations
+import ordering
+import pagecache
+import product_import
+import receipts
+import reports
+import slowlog
+import tasks
+from db import get_db
+
+
+def prepare_db(conn):
+    migrations.migrate(conn)
 
 
 app = Flask(__name__)
-DB_PATH = "Databases/boutique.db"
-UPLOAD_FOLDER = "static/images"
+db.init_app(app, prepare_db)
+metrics.init_app(app)
+slowlog.init_app(app)
+UPLOAD_FOLDER = images.IMAGE_ROOT
 
 
 # Add this new function to check for duplicate product names
 def check_duplicate_product_name(name, exclude_id=None):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     if exclude_id:
-        cursor.execute("SELECT id FROM products WHERE LOWER(name) = ? AND id != ?", (name.lower(), exclude_id))
+        cursor.execute("SELECT id FROM products WHERE LOWER(name) = ? AND id != ?", (catalog.name_key(name), exclude_id))
     else:
-        cursor.execute("SELECT id FROM products WHERE LOWER(name) = ?", (name.lower(),))
+        cursor.execute("SELECT id FROM products WHERE LOWER(name) = ?", (catalog.name_key(name),))
     result = cursor.fetchone()
-    conn.close()
     return result is not None
 
 
+@app.template_global()
+def image_variants(path):
+    return images.variants(path)
+
+
+@app.route("/static/images/<path:filename>")
+def product_image(filename):
+    # Uploads may live outside static/ (BOUTIQUE_IMAGES)
+    return send_from_directory(images.IMAGE_ROOT, filename)
+
+
+@app.after_request
+def cache_hashed_images(response):
+    # Content-hashed uploads and their variants never change under a name
+    if request.path.startswith("/static/images/") and images.is_immutable(request.path.rsplit("/", 1)[-1]):
+        response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+
 @app.errorhandler(500)
 def internal_error(error):
     return render_template('500.html', error=error), 500
@@ -40,45 +87,23 @@ if not os.path.exists(UPLOAD_FOLDER):
 
 
 def get_products(category_id=None):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    snap, stock = catalog.snapshot(), catalog.stock()
     if category_id:
-        cursor.execute(
-            "SELECT id, name, price, image, inventory FROM products WHERE category_id = ? ORDER BY position ASC, id ASC",
-            (category_id,),
-        )
-    else:
-        cursor.execute(
-            "SELECT id, name, price, image, inventory FROM products ORDER BY position ASC, id ASC"
-        )
-    products = cursor.fetchall()
-    conn.close()
-    return products
+        return [p + (stock.get(p[0], 0),) for p in snap.by_category.get(category_id, [])]
+    return [p[:4] + (stock.get(p[0], 0),) for p in snap.products]
 
 
 def get_products_grouped_by_category():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, name, price, image, inventory, category_id FROM products ORDER BY category_id ASC, position ASC, id ASC"
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    products_by_cat = {}
-    for pid, name, price, image, inventory, cat_id in rows:
-        products_by_cat.setdefault(cat_id, []).append((pid, name, price, image, inventory))
-    return products_by_cat
+    stock = catalog.stock()
+    return {
+        cid: [p + (stock.get(p[0], 0),) for p in rows]
+        for cid, rows in catalog.snapshot().by_category.items()
+    }
 
 
 def get_all_products_with_category():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT id, name, price, image, inventory, category_id FROM products ORDER BY position ASC, id ASC"
-    )
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
+    stock = catalog.stock()
+    return [p[:4] + (stock.get(p[0], 0), p[4]) for p in catalog.snapshot().products]
 
 
 def smart_capitalize(name):
@@ -103,25 +128,118 @@ def smart_capitalize(name):
 
 @app.route("/")
 def index():
-    cats = get_categories()
-    prods = get_all_products_with_category()
-    return render_template("index.html", categories=cats, products=prods)
+    snap = catalog.snapshot()
+    # base.html shows the admin badge/links, so admins get their own copy
+    is_admin = bool(session.get("is_admin"))
+    # Products are fetched lazily from /api/products; the page only needs the
+    # category list and how many products each one has
+    categories = [(cid, name, len(snap.by_category.get(cid, []))) for cid, name in snap.categories]
+    # snap.version leaves stock out, so sales don't throw the page away
+    return pagecache.cached(
+        ("index", is_admin),
+        snap.version,
+        lambda: render_template("index.html", categories=categories),
+    )
+
+PRODUCT_FIELDS = ("id", "name", "price", "image", "inventory", "category_id")
+# Columns of a catalog snapshot row; inventory comes from catalog.stock()
+SNAPSHOT_FIELDS = ("id", "name", "price", "image", "category_id")
+DEFAULT_PRODUCT_FIELDS = ("id", "name", "price", "image", "category_id")
+PRODUCTS_PAGE_SIZE = 60
+PRODUCTS_MAX_PAGE_SIZE = 500
+
+
+@app.route("/api/products")
+def api_products():
+    # ?category_id=&after=<last product id>&limit=&fields=id,name,...
+    snap = catalog.snapshot()
+    try:
+        category_id = int(request.args["category_id"]) if request.args.get("category_id") else None
+        after = int(request.args["after"]) if request.args.get("after") else None
+        limit = int(request.args.get("limit", PRODUCTS_PAGE_SIZE))
+    except ValueError:
+        return {"error": "Bad parameter"}, 400
+    limit = max(1, min(PRODUCTS_MAX_PAGE_SIZE, limit))
+    fields = [f for f in request.args.get("fields", "").split(",") if f in PRODUCT_FIELDS] or DEFAULT_PRODUCT_FIELDS
+    if category_id:
+        rows, rank = snap.category_rows.get(category_id, []), snap.category_rank
+    else:
+        rows, rank = snap.products, snap.rank
+    start = 0
+    if after is not None:
+        # The cursor is just a product id. If it isn't in this listing (deleted,
+        # moved to another category, or never in it) the listing ends rather
+        # than repeat rows. category_rank counts within the product's own
+        # category, hence the category check. A reorder between pages isn't
+        # detected: paging simply continues after the product's new place.
+        product = snap.by_id.get(after)
+        if product is not None and (category_id is None or product[4] == category_id):
+            start = rank[after] + 1
+        else:
+            start = len(rows)
+    page = rows[start:start + limit]
+    columns = [(f, SNAPSHOT_FIELDS.index(f)) for f in fields if f != "inventory"]
+    stock = catalog.stock() if "inventory" in fields else None
+    items = []
+    for row in page:
+        item = {f: row[i] for f, i in columns}
+        if stock is not None:
+            item["inventory"] = stock.get(row[0], 0)
+        # Resized variants ride along with the original path once they exist
+        if "image" in item:
+            item.update(images.variants(item["image"]) or {})
+        items.append(item)
+    response = jsonify(
+        items=items,
+        next=page[-1][0] if page and start + limit < len(rows) else None,
+    )
+    if stock is None:
+        # The catalog version leaves stock out, so sales keep these ETags
+        response.set_etag(hashlib.sha1(f"{snap.version}{request.full_path}".encode()).hexdigest()[:20])
+    else:
+        # Stock moves with every sale, but rarely on the page asked for
+        response.set_etag(hashlib.sha1(response.get_data()).hexdigest()[:20])
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    # Prometheus scrape from the tablet itself, or an admin with a browser
+    if not session.get("is_admin") and request.remote_addr not in ("127.0.0.1", "::1"):
+        return "Unauthorized", 403
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+@app.route("/sw.js")
+def service_worker():
+    # Served from the root so the worker's scope covers the whole app
+    response = send_from_directory(app.static_folder, "sw.js", mimetype="text/javascript", max_age=0)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 
 @app.route("/submit_order", methods=["POST"]) 
 def submit_order():
     return redirect("/")
 
 def get_categories():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    # Order by explicit position, then name
-    cursor.execute("SELECT id, name FROM categories ORDER BY position ASC, name ASC")
-    categories = cursor.fetchall()
-    conn.close()
-    return categories
+    return catalog.snapshot().categories
 
 @app.route("/inventory")
 def inventory_manager():
+    # Offline sales that oversold: show each once
+    conn = get_db()
+    unseen = conn.execute(
+        "SELECT id, order_id, product_id, product_name, requested, available FROM stock_conflicts WHERE seen_at IS NULL ORDER BY id"
+    ).fetchall()
+    if unseen:
+        for _, order_id, product_id, product_name, requested, available in unseen:
+            if available is None:
+                flash(f"Venta sin conexión (pedido #{order_id}): producto no encontrado (ID: {product_id}), vendido: {requested}", "error")
+            else:
+                flash(f"Venta sin conexión (pedido #{order_id}): {product_name} - Vendido: {requested}, Disponible: {available}. El inventario quedó en 0.", "error")
+        conn.executemany("UPDATE stock_conflicts SET seen_at = datetime('now') WHERE id = ?", [(row[0],) for row in unseen])
+        conn.commit()
     # If prior purchase attempt had conflicts, show them as flashes
     if session.get('inventory_conflicts'):
         conflicts = session.pop('inventory_conflicts')
@@ -149,7 +267,8 @@ def inventory_manager():
         products_with_category = get_all_products_with_category()
     
     categories = get_categories()
-    return render_template("inventory.html", products=products_with_category, categories=categories, selected_category=category_id_int)
+    thumbs = {p[0]: v["thumb"] for p in products_with_category if (v := images.variants(p[3]))}
+    return render_template("inventory.html", products=products_with_category, categories=categories, selected_category=category_id_int, thumbs=thumbs)
 
 @app.route("/inventory/update", methods=["POST"])
 def inventory_update():
@@ -157,7 +276,7 @@ def inventory_update():
         return "Unauthorized", 403
     product_ids = request.form.getlist("product_id")
     received_qtys = request.form.getlist("received_qty")
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     updated = 0
     for idx, pid in enumerate(product_ids):
@@ -169,8 +288,8 @@ def inventory_update():
             continue
         c.execute("UPDATE products SET inventory = inventory + ? WHERE id = ?", (qty, pid))
         updated += 1
+    catalog.bump_stock(conn)
     conn.commit()
-    conn.close()
     if updated:
         flash(f"Inventario actualizado para {updated} producto(s).", "success")
     else:
@@ -178,6 +297,42 @@ def inventory_update():
     next_category = request.form.get("category_id") or ""
     return redirect(url_for("inventory_manager", category_id=next_category))
 
+@app.route("/inventory/import", methods=["POST"])
+def inventory_import():
+    # Dry run: read the sheet, show what would change, keep it for confirmation
+    if not session.get("is_admin"):
+        return "Unauthorized", 403
+    upload = request.files.get("sheet")
+    if not upload or not upload.filename:
+        flash("Selecciona un archivo CSV o XLSX.", "error")
+        return redirect(url_for("inventory_manager"))
+    try:
+        sheet = product_import.read_sheet(upload.filename, upload.read())
+    except product_import.SheetError as e:
+        flash(str(e), "error")
+        return redirect(url_for("inventory_manager"))
+    result = product_import.plan(get_db(), sheet, smart_capitalize)
+    token = product_import.save_pending(sheet)
+    return render_template("inventory_import.html", result=result, token=token, filename=upload.filename)
+
+
+@app.route("/inventory/import/apply", methods=["POST"])
+def inventory_import_apply():
+    if not session.get("is_admin"):
+        return "Unauthorized", 403
+    token = request.form.get("token", "")
+    sheet = product_import.claim_pending(token)
+    if sheet is None:
+        flash("La importación expiró o ya se aplicó; vuelve a subir el archivo.", "error")
+        return redirect(url_for("inventory_manager"))
+    result = product_import.apply(get_db(), sheet, smart_capitalize)
+    if result.errors:
+        # The DB changed since the dry run in a way that breaks a line
+        return render_template("inventory_import.html", result=result, token=token, filename=request.form.get("filename", ""))
+    flash(f"Importación aplicada: {len(result.new_products)} producto(s) nuevo(s), {len(result.updates)} actualizado(s).", "success")
+    return redirect(url_for("inventory_manager"))
+
+
 @app.route("/manage", methods=["GET"])
 def manage():
     if not session.get("is_admin"):
@@ -186,30 +341,45 @@ def manage():
     products_by_category = get_products_grouped_by_category()
     return render_template("manage.html", categories=categories, products_by_category=products_by_category)
 
-@app.route("/manage/update_category_positions", methods=["POST"])
-def update_category_positions():
+def move_item(table):
+    """Shared body of the drag-and-drop endpoints.
+
+    JSON: {id, before_id, after_id} where the neighbours are the items now
+    directly above and below the moved one (null at either end).
+    """
     if not session.get("is_admin"):
         return "Unauthorized", 403
     data = request.get_json(silent=True) or {}
-    ordered_ids = data.get("ordered_category_ids", [])
-    if not isinstance(ordered_ids, list):
+    try:
+        item_id = int(data["id"])
+        before_id, after_id = (int(data[k]) if data.get(k) not in (None, "") else None for k in ("before_id", "after_id"))
+    except (KeyError, TypeError, ValueError):
         return {"status": "error", "message": "Bad payload"}, 400
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+    conn = get_db()
+    conn.execute("BEGIN IMMEDIATE")
     try:
-        for idx, cid in enumerate(ordered_ids, start=1):
-            try:
-                cid_int = int(cid)
-            except Exception:
-                continue
-            c.execute("UPDATE categories SET position = ? WHERE id = ?", (idx, cid_int))
+        position = ordering.move(conn, table, item_id, before_id, after_id)
+        catalog.bump(conn)
         conn.commit()
-        return {"status": "success"}, 200
-    except Exception as e:
+    except ordering.StaleOrder as e:
+        conn.rollback()
+        # The page is out of date; the client reloads it
+        return {"status": "stale", "message": str(e)}, 409
+    except Exception:
         conn.rollback()
-        return {"status": "error", "message": str(e)}, 500
-    finally:
-        conn.close()
+        raise
+    return {"status": "success", "position": position}, 200
+
+
+@app.route("/manage/move_category", methods=["POST"])
+def move_category():
+    return move_item("categories")
+
+
+@app.route("/manage/move_product", methods=["POST"])
+def move_product():
+    return move_item("products")
+
 
 @app.route("/manage/add_category", methods=["POST"])
 def manage_add_category():
@@ -219,20 +389,18 @@ def manage_add_category():
     if not name:
         flash("Nombre de categoría requerido.", "error")
         return redirect(url_for("manage"))
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
-        # Append to end: set position = current max + 1
-        c.execute("SELECT COALESCE(MAX(position), 0) FROM categories")
-        next_pos = (c.fetchone()[0] or 0) + 1
+        # Append to end, one gap after the current last category
+        next_pos = ordering.next_position(conn, "categories")
         c.execute("INSERT INTO categories (name, position) VALUES (?, ?)", (name, next_pos))
+        catalog.bump(conn)
         conn.commit()
         flash(f"Categoría '{name}' agregada.", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error al agregar categoría: {e}", "error")
-    finally:
-        conn.close()
     return redirect(url_for("manage"))
 
 @app.route("/manage/update_category", methods=["POST"])
@@ -244,17 +412,16 @@ def manage_update_category():
     if not category_id or not new_name:
         flash("Categoría y nombre requeridos.", "error")
         return redirect(url_for("manage"))
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
         c.execute("UPDATE categories SET name = ? WHERE id = ?", (new_name, category_id))
+        catalog.bump(conn)
         conn.commit()
         flash("Categoría actualizada.", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error al actualizar categoría: {e}", "error")
-    finally:
-        conn.close()
     return redirect(url_for("manage", category_id=category_id))
 
 @app.route("/manage/delete_category", methods=["POST"])
@@ -265,23 +432,21 @@ def manage_delete_category():
     if not category_id:
         flash("Categoría requerida.", "error")
         return redirect(url_for("manage"))
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
         # Prevent deleting if products exist in this category
         c.execute("SELECT COUNT(*) FROM products WHERE category_id = ?", (category_id,))
         if (c.fetchone() or [0])[0] > 0:
             flash("No se puede eliminar categoría con productos. Mueve o elimina los productos primero.", "error")
-            conn.close()
             return redirect(url_for("manage", category_id=category_id))
         c.execute("DELETE FROM categories WHERE id = ?", (category_id,))
+        catalog.bump(conn)
         conn.commit()
         flash("Categoría eliminada.", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error al eliminar categoría: {e}", "error")
-    finally:
-        conn.close()
     return redirect(url_for("manage"))
 
 @app.route("/manage/add_product", methods=["POST"])
@@ -310,28 +475,23 @@ def manage_add_product():
         start_inventory_int = 0
     image = request.files.get("image")
     if image and image.filename:
-        filename = secure_filename(image.filename)
-        image_path = os.path.join(UPLOAD_FOLDER, filename)
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        image.save(image_path)
+        image_path = images.save_upload(image)
     else:
         image_path = ""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
-        c.execute("SELECT COALESCE(MAX(position), 0) FROM products WHERE category_id = ?", (category_id_int,))
-        next_position = (c.fetchone()[0] or 0) + 1
+        next_position = ordering.next_position(conn, "products", "category_id = ?", (category_id_int,))
         c.execute(
             "INSERT INTO products (name, price, image, position, category_id, inventory) VALUES (?, ?, ?, ?, ?, ?)",
             (name, price, image_path, next_position, category_id_int, start_inventory_int),
         )
+        catalog.bump(conn)
         conn.commit()
         flash(f"Producto '{name}' agregado.", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error al agregar producto: {e}", "error")
-    finally:
-        conn.close()
     return redirect(url_for("manage", category_id=category_id_int))
 
 @app.route("/manage/update_product", methods=["POST"])
@@ -347,11 +507,8 @@ def manage_update_product():
     raw_price = request.form.get("price", "0").strip()
     image = request.files.get("image")
     
-    # Debug logging
-    print(f"DEBUG update_product: product_id={product_id}, name={name}, price={raw_price}")
-    print(f"DEBUG update_product: image={image}, image.filename={image.filename if image else None}")
-    print(f"DEBUG update_product: request.files keys={list(request.files.keys())}")
-    print(f"DEBUG update_product: request.form keys={list(request.form.keys())}")
+    app.logger.debug("update_product: product_id=%s, name=%s, price=%s", product_id, name, raw_price)
+    app.logger.debug("update_product: image=%s, files=%s, form=%s", image.filename if image else None, list(request.files.keys()), list(request.form.keys()))
     
     # 3. Validations
     if not product_id:
@@ -375,28 +532,14 @@ def manage_update_product():
         price = 0
     
     # 5. Connect to DB
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     try:
-        # 6. Handle Image (The Fix)
+        # 6. Handle Image
         if image and image.filename:
-            filename = secure_filename(image.filename)
-            
-            # Use absolute path to be safe on both Windows and Termux
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            save_folder = os.path.join(base_dir, 'static', 'images')
-            
-            # Make sure folder exists
-            os.makedirs(save_folder, exist_ok=True)
-            
-            # A. System Path: For saving the file to the disk (Uses \ on Windows, / on Termux)
-            system_path = os.path.join(save_folder, filename)
-            image.save(system_path)
-            
-            # B. Database Path: For the URL (Always uses /)
-            # We hardcode this so Android doesn't get confused by Windows backslashes
-            db_path = f"static/images/{filename}"
+            # Stored under its content hash; thumbnails are made in the background
+            db_path = images.save_upload(image)
             
             # Update including image
             c.execute("UPDATE products SET name = ?, price = ?, image = ? WHERE id = ?", 
@@ -406,13 +549,12 @@ def manage_update_product():
             c.execute("UPDATE products SET name = ?, price = ? WHERE id = ?", 
                      (name, price, product_id))
         
+        catalog.bump(conn)
         conn.commit()
         flash("Producto actualizado exitosamente.", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error al actualizar producto: {e}", "error")
-    finally:
-        conn.close()
     
     return redirect(url_for("manage", category_id=return_category_id))
 
@@ -439,115 +581,184 @@ def add_product_inventory():
         start_inventory_int = 0
     image = request.files.get("image")
     if image and image.filename:
-        filename = secure_filename(image.filename)
-        image_path = os.path.join(UPLOAD_FOLDER, filename)
-        os.makedirs(os.path.dirname(image_path), exist_ok=True)
-        image.save(image_path)
+        image_path = images.save_upload(image)
     else:
         image_path = ""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     try:
         # Determine next position within category
-        c.execute("SELECT COALESCE(MAX(position), 0) FROM products WHERE category_id = ?", (category_id_int,))
-        next_position = (c.fetchone()[0] or 0) + 1
+        next_position = ordering.next_position(conn, "products", "category_id = ?", (category_id_int,))
         c.execute(
             "INSERT INTO products (name, price, image, position, category_id, inventory) VALUES (?, ?, ?, ?, ?, ?)",
             (name, price, image_path, next_position, category_id_int, start_inventory_int),
         )
+        catalog.bump(conn)
         conn.commit()
         flash(f"Producto '{name}' agregado.", "success")
     except Exception as e:
         conn.rollback()
         flash(f"Error al agregar producto: {e}", "error")
-    finally:
-        conn.close()
     return redirect(url_for("inventory_manager", category_id=category_id_int))
 
+
+def parse_sold_at(value):
+    """Client sale time (ISO 8601) as an orders.created_at string, or None."""
+    try:
+        sold_at = datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+    if sold_at.tzinfo is None:
+        return None
+    now = datetime.now(timezone.utc)
+    # A register clock running ahead must not put sales in the future
+    return min(sold_at.astimezone(timezone.utc), now).strftime("%Y-%m-%d %H:%M:%S")
+
+
 @app.route("/api/purchase", methods=["POST"])
 def api_purchase():
-    # JSON: { items: [{product_id, qty}] }
+    # JSON: { items: [{product_id, qty, discount_percent}], reconcile, sold_at }
+    # reconcile=true comes from the register's outbox: the sale already
+    # happened at the counter, so a stock shortfall is recorded instead of
+    # rejecting the order. An Idempotency-Key header makes retries safe.
     data = request.get_json(silent=True) or {}
     items = data.get("items", [])
     if not items:
         return {"error": "No items"}, 400
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # Check inventory
-    conflicts = []
-    product_cache = {}
+    reconcile = bool(data.get("reconcile"))
+    sold_at = parse_sold_at(data["sold_at"]) if reconcile and data.get("sold_at") else None
+    # Keep only well-formed lines; the same product may appear more than once
+    lines = []
+    requested = {}
     for entry in items:
         try:
             pid = int(entry.get("product_id"))
             qty = int(entry.get("qty"))
         except Exception:
             continue
-        c.execute("SELECT inventory, name, price, category_id FROM products WHERE id = ?", (pid,))
-        row = c.fetchone()
-        if not row:
-            conflicts.append({"product_id": pid, "reason": "not_found"})
+        if qty <= 0:
             continue
-        inv, pname, pprice, cat_id = row
-        # Get category name
-        category_name = "Unknown"
-        if cat_id:
-            c.execute("SELECT name FROM categories WHERE id = ?", (cat_id,))
-            cat_row = c.fetchone()
-            if cat_row:
-                category_name = cat_row[0]
-        product_cache[pid] = {"name": pname, "price": int(pprice), "category": category_name}
-        if qty > inv:
-            conflicts.append({
-                "product_id": pid,
-                "product_name": pname,
-                "requested": qty,
-                "available": inv,
-                "category": category_name,
-            })
-    if conflicts:
-        conn.close()
-        # Store conflicts for display on inventory page and instruct client to redirect
-        session['inventory_conflicts'] = conflicts
-        return {"status": "conflict", "redirect": "/inventory"}, 409
-    # Deduct inventory
-    for entry in items:
-        pid = int(entry.get("product_id"))
-        qty = int(entry.get("qty"))
-        c.execute("UPDATE products SET inventory = inventory - ? WHERE id = ?", (qty, pid))
-    # Create order + order_items
-    # Compute totals with discounts
-    order_items_rows = []
-    order_total = 0
-    for entry in items:
-        pid = int(entry.get("product_id"))
-        qty = int(entry.get("qty"))
-        discount_percent = int(entry.get("discount_percent", 0))
+        try:
+            discount_percent = int(entry.get("discount_percent", 0))
+        except Exception:
+            discount_percent = 0
         # Clamp discount between 0 and 25
-        discount_percent = max(0, min(25, discount_percent))
-        info = product_cache.get(pid) or {"name": "Product #"+str(pid), "price": 0, "category": "Unknown"}
-        unit_price = int(info["price"]) if isinstance(info, dict) else 0
-        original_line_total = unit_price * qty
-        discount_amount = round(original_line_total * discount_percent / 100)
-        line_total = original_line_total - discount_amount
-        order_total += line_total
-        category_name = info.get("category", "Unknown") if isinstance(info, dict) else "Unknown"
-        order_items_rows.append((pid, info["name"] if isinstance(info, dict) else str(info), category_name, unit_price, qty, line_total, discount_percent))
-    c.execute("INSERT INTO orders (total) VALUES (?)", (order_total,))
-    order_id = c.lastrowid
-    for pid, pname, category_name, unit_price, qty, line_total, discount_percent in order_items_rows:
+        lines.append((pid, qty, max(0, min(25, discount_percent))))
+        requested[pid] = requested.get(pid, 0) + qty
+    if not lines:
+        return {"error": "No items"}, 400
+    key = idempotency.request_key(request, data)
+    # reconcile is how the sale is delivered, not what was sold: the outbox
+    # sends the live attempt without it and any replay with it
+    request_hash = idempotency.fingerprint({"lines": lines})
+    conn = get_db()
+    c = conn.cursor()
+    # One write transaction for check + deduct + order rows, so two registers
+    # selling the last unit can't both pass the stock check
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # Checked under the write lock, so a retry racing the original waits
+        # for it and then finds its answer
+        stored = idempotency.lookup(conn, key) if key else None
+        if stored:
+            conn.rollback()
+            stored_hash, response, status = stored
+            if stored_hash != request_hash:
+                return {"error": "Idempotency-Key already used for a different purchase"}, 422
+            return response, status, {"Idempotent-Replayed": "true"}
+        # Resolve every cart product and its category name in one query
+        placeholders = ",".join("?" * len(requested))
         c.execute(
+            f"SELECT p.id, p.inventory, p.name, p.price, COALESCE(cat.name, 'Unknown') FROM products p LEFT JOIN categories cat ON cat.id = p.category_id WHERE p.id IN ({placeholders})",
+            list(requested),
+        )
+        products = {row[0]: row[1:] for row in c.fetchall()}
+        # Single pass: check stock, price, and build order_items rows
+        conflicts = []
+        checked = set()
+        order_items_rows = []
+        order_total = 0
+        for pid, qty, discount_percent in lines:
+            product = products.get(pid)
+            first_seen = pid not in checked
+            checked.add(pid)
+            if product is None:
+                if first_seen:
+                    conflicts.append({"product_id": pid, "reason": "not_found"})
+                continue
+            inv, pname, pprice, category_name = product
+            if first_seen and requested[pid] > inv:
+                conflicts.append({
+                    "product_id": pid,
+                    "product_name": pname,
+                    "requested": requested[pid],
+                    "available": inv,
+                    "category": category_name,
+                })
+            unit_price = int(pprice)
+            original_line_total = unit_price * qty
+            discount_amount = round(original_line_total * discount_percent / 100)
+            line_total = original_line_total - discount_amount
+            order_total += line_total
+            order_items_rows.append((pid, pname, category_name, unit_price, qty, line_total, discount_percent))
+        if conflicts and not reconcile:
+            conn.rollback()
+            # Store conflicts for display on inventory page and instruct client to redirect
+            session['inventory_conflicts'] = conflicts
+            return {"status": "conflict", "redirect": "/inventory"}, 409
+        if reconcile:
+            if not order_items_rows:
+                conn.rollback()
+                return {"error": "No items"}, 400
+            # Sell what is there, never below 0; the rest is recorded below
+            c.executemany(
+                "UPDATE products SET inventory = MAX(inventory - ?, 0) WHERE id = ?",
+                [(qty, pid) for pid, qty in requested.items() if pid in products],
+            )
+        else:
+            # Deduct inventory; the guard makes a negative stock impossible even if
+            # something slipped past the check above
+            deductions = [(qty, pid, qty) for pid, qty in requested.items()]
+            c.executemany("UPDATE products SET inventory = inventory - ? WHERE id = ? AND inventory >= ?", deductions)
+            if c.rowcount != len(deductions):
+                conn.rollback()
+                return {"status": "conflict", "redirect": "/inventory"}, 409
+        # Create order + order_items
+        if sold_at:
+            c.execute("INSERT INTO orders (total, created_at) VALUES (?, ?)", (order_total, sold_at))
+        else:
+            c.execute("INSERT INTO orders (total) VALUES (?)", (order_total,))
+        order_id = c.lastrowid
+        if conflicts:
+            c.executemany(
+                "INSERT INTO stock_conflicts (order_id, product_id, product_name, requested, available) VALUES (?, ?, ?, ?, ?)",
+                [(order_id, x["product_id"], x.get("product_name", ""), x.get("requested", requested[x["product_id"]]), x.get("available")) for x in conflicts],
+            )
+        c.executemany(
             "INSERT INTO order_items (order_id, product_id, product_name, category_name, unit_price, quantity, line_total, discount_percent) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-            (order_id, pid, pname, category_name, unit_price, qty, line_total, discount_percent)
+            [(order_id,) + row for row in order_items_rows],
         )
-    conn.commit()
-    conn.close()
-    return {"status": "ok", "order_id": order_id, "total": order_total}, 200
+        reports.apply_order(conn, order_id)
+        catalog.bump_stock(conn)
+        response = {
+            "status": "ok",
+            "order_id": order_id,
+            # /gracias/<receipt> shows it; the bare id would let anyone list orders
+            "receipt": receipts.token(order_id, app.secret_key),
+            "total": order_total,
+            "conflicts": len(conflicts),
+        }
+        if key:
+            idempotency.remember(conn, key, request_hash, response)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return response, 200
 
 @app.route("/inventory/bulk_update", methods=["POST"])
+@app.route("/products/bulk_update", methods=["POST"])
 def bulk_update_products():
- 
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
     # Get all product ids from the form
     ids = request.form.getlist('id')
     names = request.form.getlist('name')
@@ -555,38 +766,28 @@ def bulk_update_products():
     positions = request.form.getlist('position')
     new_category_ids = request.form.getlist('new_category_id')  # optional per item
     # For file uploads, use request.files.getlist for all images
-    images = request.files.getlist('image')
+    uploads = request.files.getlist('image')
+    return_to = url_for("manage", category_id=request.form.get('return_category_id') or '')
 
-    for idx, prod_id in enumerate(ids):
+    # Parse every row up front: (id, name, price, position, upload, target category)
+    rows = []
+    for idx, raw_id in enumerate(ids):
+        try:
+            prod_id = int(raw_id)
+        except ValueError:
+            continue
         name = smart_capitalize(names[idx])
-        if check_duplicate_product_name(name, exclude_id=prod_id):
-            conn.close()
-            flash(f"El nombre del producto '{name}' ya existe. Los nombres de productos deben ser únicos.", "error")
-            return redirect("/inventory")
-        
-
-    for idx, prod_id in enumerate(ids):
-        name = names[idx]
-        name = smart_capitalize(name)
         raw_price = prices[idx].strip()
         try:
             clean_price = re.sub(r'[^\d-]', '', raw_price)  # Keep digits and minus sign
             price = int(clean_price)  # Convert to integer, allows negative
         except ValueError:
             price = 0
-        position = int(positions[idx]) if positions[idx].isdigit() else idx + 1
-        image = images[idx] if idx < len(images) else None
-        # Handle image upload or keep existing
-        if image and image.filename:
-            filename = secure_filename(image.filename)
-            save_path = os.path.join(UPLOAD_FOLDER, filename)
-            image.save(save_path)
-            image_path = save_path
-        else:
-            c.execute("SELECT image FROM products WHERE id = ?", (prod_id,))
-            current_image = c.fetchone()
-            image_path = current_image[0] if current_image else ''
-
+        # Missing (the Mover form sends none), 0 or garbage: keep the stored
+        # position, so the row only counts as changed for what really changed
+        raw_position = positions[idx].strip() if idx < len(positions) else ""
+        position = int(raw_position) if raw_position.isdigit() and int(raw_position) > 0 else None
+        image = uploads[idx] if idx < len(uploads) else None
         # Optional category move
         target_category_id = None
         if idx < len(new_category_ids):
@@ -595,29 +796,92 @@ def bulk_update_products():
                 target_category_id = int(val) if val not in (None, '', 'null') else None
             except Exception:
                 target_category_id = None
+        rows.append((prod_id, name, price, position, image, target_category_id))
+    if not rows:
+        return redirect(return_to)
+
+    # Names must be unique across the table and within the batch itself
+    owners = {}
+    for prod_id, name, *_ in rows:
+        if owners.setdefault(catalog.name_key(name), prod_id) != prod_id:
+            flash(f"El nombre del producto '{name}' está repetido. Los nombres de productos deben ser únicos.", "error")
+            return redirect("/inventory")
 
-        if target_category_id is not None:
-            # When moving, also set a position at the end of the destination category
-            c.execute("SELECT COALESCE(MAX(position), 0) FROM products WHERE category_id = ?", (target_category_id,))
-            next_position = (c.fetchone()[0] or 0) + 1
+    # Store uploads before taking the write lock; an unused file is collected later
+    image_paths = {row[0]: images.save_upload(row[4]) for row in rows if row[4] and row[4].filename}
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        lowered = list(owners)
+        c.execute(
+            f"SELECT id, name FROM products WHERE LOWER(name) IN ({','.join('?' * len(lowered))})",
+            lowered,
+        )
+        for other_id, other_name in c.fetchall():
+            if owners.get(catalog.name_key(other_name), other_id) != other_id:
+                conn.rollback()
+                flash(f"El nombre del producto '{other_name}' ya existe. Los nombres de productos deben ser únicos.", "error")
+                return redirect("/inventory")
+
+        row_ids = [row[0] for row in rows]
+        c.execute(
+            f"SELECT id, name, price, image, position, category_id FROM products WHERE id IN ({','.join('?' * len(row_ids))})",
+            row_ids,
+        )
+        current = {row[0]: row[1:] for row in c.fetchall()}
+        # Moved products go to the end of their destination category
+        targets = {row[5] for row in rows if row[5] is not None}
+        next_position = {}
+        if targets:
             c.execute(
+                f"SELECT category_id, COALESCE(MAX(position), 0) FROM products WHERE category_id IN ({','.join('?' * len(targets))}) GROUP BY category_id",
+                list(targets),
+            )
+            next_position = dict(c.fetchall())
+
+        updates = []
+        for prod_id, name, price, position, _, target_category_id in rows:
+            if prod_id not in current:
+                continue
+            old_name, old_price, old_image, old_position, old_category_id = current[prod_id]
+            category_id = old_category_id
+            if position is None:
+                position = old_position
+            if target_category_id is not None and target_category_id != old_category_id:
+                next_position[target_category_id] = next_position.get(target_category_id, 0) + ordering.POSITION_GAP
+                position, category_id = next_position[target_category_id], target_category_id
+            new = (name, price, image_paths.get(prod_id, old_image), position, category_id)
+            # Only rows that actually changed are written
+            if new != current[prod_id]:
+                updates.append(new + (prod_id,))
+        if updates:
+            c.executemany(
                 "UPDATE products SET name = ?, price = ?, image = ?, position = ?, category_id = ? WHERE id = ?",
-                (name, price, image_path, next_position, target_category_id, prod_id)
+                updates,
             )
-        else:
-            c.execute("UPDATE products SET name = ?, price = ?, image = ?, position = ? WHERE id = ?", (name, price, image_path, position, prod_id))
-    conn.commit()
-    conn.close()
-    return redirect(url_for("manage", category_id=request.form.get('return_category_id') or ''))
+            catalog.bump(conn)
+        conn.commit()
+    except sqlite3.IntegrityError:
+        # The checks above mirror UNIQUE(name); should they ever miss a case,
+        # tell the user instead of failing with a 500
+        conn.rollback()
+        flash("No se pudieron guardar los cambios: los nombres de productos deben ser únicos.", "error")
+        return redirect("/inventory")
+    except Exception:
+        conn.rollback()
+        raise
+    return redirect(return_to)
 
 @app.route("/products/delete", methods=["POST"])
 def delete_product():
     name = request.form["name"]
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM products WHERE name = ?", (name,))
+    catalog.bump(conn)
     conn.commit()
-    conn.close()
     return redirect(url_for("manage", category_id=request.form.get('return_category_id') or ''))
 
 @app.route("/products/add", methods=["POST"])
@@ -637,23 +901,16 @@ def add_product():
         price = 0
     image = request.files.get("image")
     if image and image.filename:
-        filename = secure_filename(image.filename)
-        image_path = os.path.join(UPLOAD_FOLDER,filename)
-        image.save(image_path)
+        image_path = images.save_upload(image)
     else:
         image_path = ""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
-    # Get the current max position
-    cursor.execute("SELECT MAX(position) FROM products")
-    max_position = cursor.fetchone()[0]
-    if max_position is None:
-        new_position = 1
-    else:
-        new_position = max_position + 1
+    # Append after the current last product (these have no category)
+    new_position = ordering.next_position(conn, "products", "category_id IS NULL")
     cursor.execute("INSERT INTO products (name, price, image, position) VALUES (?, ?, ?, ?)", (name, price, image_path, new_position))
+    catalog.bump(conn)
     conn.commit()
-    conn.close()
     return redirect("/inventory")
 
 
@@ -679,7 +936,7 @@ def logout():
 
 @app.route("/logout", methods=["GET"])
 def logout_get():
-    print(f"Logout GET called - this should not happen")
+    app.logger.debug("Logout GET called - this should not happen")
     return "Please use the logout button in the footer", 405
 
 
@@ -687,44 +944,162 @@ def parse_order_total(items):
     return sum(it.get('line_total', 0) for it in items)
 
 
+CHART_PAGE_SIZE = 50
+CHART_DEFAULT_DAYS = 30
+
+
+def parse_date_range(args, default_days=CHART_DEFAULT_DAYS):
+    """Read ?start=YYYY-MM-DD&end=YYYY-MM-DD (inclusive), defaulting to the last few days.
+
+    Days are UTC days, as created_at and the rollup buckets are stored, so
+    "today" is today in UTC too.
+    """
+    today = datetime.now(timezone.utc).date()
+    try:
+        end_day = datetime.strptime(args.get("end", ""), "%Y-%m-%d").date()
+    except ValueError:
+        end_day = today
+    try:
+        start_day = datetime.strptime(args.get("start", ""), "%Y-%m-%d").date()
+    except ValueError:
+        start_day = end_day - timedelta(days=default_days - 1)
+    if start_day > end_day:
+        start_day, end_day = end_day, start_day
+    return start_day, end_day
+
+
 @app.route("/chart", methods=["GET"])
 def chart():
-    # Show all recorded purchases
-    conn = sqlite3.connect(DB_PATH)
+    # Purchases in a date range, newest first, one page at a time
+    start_day, end_day = parse_date_range(request.args)
+    # created_at is stored as 'YYYY-MM-DD HH:MM:SS', so plain string bounds work
+    lo = start_day.isoformat()
+    hi = (end_day + timedelta(days=1)).isoformat()
+    # Keyset cursor: the (created_at, id) of the last order on the previous page
+    try:
+        before = int(request.args.get("before", ""))
+        before_at = request.args["before_at"]
+    except (ValueError, KeyError):
+        before, before_at = None, None
+    conn = get_db()
     c = conn.cursor()
-    c.execute("SELECT id, created_at, total FROM orders ORDER BY id DESC")
-    orders = c.fetchall()
-    # Load items per order
-    order_id_to_items = {}
-    for oid, _, _ in orders:
-        c.execute(
-            "SELECT product_name, category_name, unit_price, quantity, line_total, discount_percent FROM order_items WHERE order_id = ? ORDER BY id ASC",
-            (oid,)
+    # Page of orders plus their items in one query. The page walks
+    # idx_orders_created_at backwards (the index carries the rowid, so
+    # created_at DESC, id DESC is its own order) and LIMIT stops it early: a
+    # page costs the same whether the range holds a day or years. The lines of
+    # those few orders are put in order here rather than by a SQL sort.
+    c.execute(
+        """
+        WITH page AS (
+            SELECT id, created_at, total FROM orders
+            WHERE created_at >= ? AND created_at < ? AND (? IS NULL OR (created_at, id) < (?, ?))
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
         )
-        order_id_to_items[oid] = c.fetchall()
-    conn.close()
-    # Transform for template
-    entries = []
-    for oid, created_at, total in orders:
-        order_items = [
-            {
-                'name': row[0],
-                'category': row[1] or 'Unknown',
-                'price': row[2],
-                'qty': row[3],
-                'line_total': row[4],
-                'discount_percent': row[5] if len(row) > 5 and row[5] is not None else 0,
+        SELECT page.id, page.created_at, page.total, oi.id,
+               oi.product_name, oi.category_name, oi.unit_price, oi.quantity, oi.line_total, oi.discount_percent
+        FROM page LEFT JOIN order_items oi ON oi.order_id = page.id
+        """,
+        (lo, hi, before_at, before_at, before, CHART_PAGE_SIZE + 1),
+    )
+    orders = {}
+    for oid, created_at, total, line_id, name, category, price, qty, line_total, discount_percent in c.fetchall():
+        entry = orders.get(oid)
+        if entry is None:
+            entry = orders[oid] = {
+                'id': oid,
+                'date': created_at,
+                'order_items': [],
+                'total': total,
             }
-            for row in order_id_to_items.get(oid, [])
-        ]
-        entries.append({
-            'id': oid,
-            'date': created_at,
-            'order_items': order_items,
-            'total': total,
-        })
-    grand_total = sum(e['total'] for e in entries)
-    return render_template("chart.html", entries=entries, grand_total=grand_total)
+        if name is not None:
+            entry['order_items'].append((line_id, {
+                'name': name,
+                'category': category or 'Unknown',
+                'price': price,
+                'qty': qty,
+                'line_total': line_total,
+                'discount_percent': discount_percent or 0,
+            }))
+    entries = sorted(orders.values(), key=lambda e: (e['date'], e['id']), reverse=True)
+    for entry in entries:
+        entry['order_items'] = [item for _, item in sorted(entry['order_items'], key=lambda line: line[0])]
+    next_before = None
+    if len(entries) > CHART_PAGE_SIZE:
+        entries = entries[:CHART_PAGE_SIZE]
+        next_before = (entries[-1]['date'], entries[-1]['id'])
+    # Range totals come from the daily rollup, not from the order log
+    order_count, grand_total = reports.period_totals(conn, start_day.isoformat(), end_day.isoformat())
+    return render_template(
+        "chart.html",
+        entries=entries,
+        grand_total=grand_total,
+        order_count=order_count,
+        start=start_day.isoformat(),
+        end=end_day.isoformat(),
+        next_before=next_before,
+        paged=before is not None,
+    )
+
+
+@app.route("/api/analytics/<report>")
+def analytics_report(report):
+    # ?start=&end= as on /chart; ?limit= for top-products; ?format=csv
+    if not session.get("is_admin"):
+        return {"error": "Unauthorized"}, 403
+    build = analytics.REPORTS.get(report)
+    if build is None:
+        abort(404)
+    start_day, end_day = parse_date_range(request.args)
+    start, end = start_day.isoformat(), end_day.isoformat()
+    try:
+        limit = max(1, min(analytics.MAX_LIMIT, int(request.args.get("limit", analytics.DEFAULT_LIMIT))))
+    except ValueError:
+        limit = analytics.DEFAULT_LIMIT
+    as_csv = request.args.get("format") == "csv"
+
+    def render():
+        rows = build(get_db(), start, end, limit)
+        if not as_csv:
+            return json.dumps({"report": report, "start": start, "end": end, "rows": rows}, ensure_ascii=False)
+        out = io.StringIO()
+        if rows:
+            writer = csv.DictWriter(out, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        return out.getvalue()
+
+    # Rendered once per range until the next sale or deleted order
+    response = pagecache.cached(
+        ("analytics", report, start, end, limit, as_csv),
+        db.version(reports.VERSION_KEY),
+        render,
+        mimetype="text/csv" if as_csv else "application/json",
+    )
+    if as_csv:
+        response.headers["Content-Disposition"] = f'attachment; filename="{report}_{start}_{end}.csv"'
+    return response
+
+
+@app.route("/export/orders.<any(csv, ndjson):fmt>")
+def export_orders(fmt):
+    # Whole history unless ?start=/?end= narrow it (same dates as /chart)
+    if not session.get("is_admin"):
+        return "Unauthorized", 403
+    if request.args.get("start") or request.args.get("end"):
+        start_day, end_day = parse_date_range(request.args)
+        lo, hi = start_day.isoformat(), (end_day + timedelta(days=1)).isoformat()
+        label = f"{start_day}_{end_day}"
+    else:
+        lo, hi, label = "", "9999", "todo"
+    if fmt == "csv":
+        body, mimetype = export.as_csv(export.rows(lo, hi)), "text/csv"
+    else:
+        body, mimetype = export.as_ndjson(export.rows(lo, hi)), "application/x-ndjson"
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f'attachment; filename="pedidos_{label}.{fmt}"'
+    response.headers["Cache-Control"] = "no-store"
+    return response
 
 
 @app.route("/orders/delete", methods=["POST"]) 
@@ -732,15 +1107,58 @@ def delete_order():
     if not session.get("is_admin"):
         return "Unauthorized", 403
     order_id = request.form.get('order_id')
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
-    c.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,))
-    c.execute("DELETE FROM orders WHERE id = ?", (order_id,))
-    conn.commit()
-    conn.close()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # Take the order back out of the rollups before its rows disappear
+        reports.apply_order(conn, order_id, sign=-1)
+        c.execute("DELETE FROM order_items WHERE order_id = ?", (order_id,))
+        c.execute("DELETE FROM orders WHERE id = ?", (order_id,))
+        receipts.bump(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
     return redirect("/chart")
 
 
+@app.cli.command("build-image-variants")
+def build_image_variants():
+    """Create missing thumbnails/WebP variants for every image on disk."""
+    queued = images.backfill()
+    tasks.join()
+    click.echo(f"Checked {queued} image(s)")
+
+
+@app.cli.command("gc-images")
+@click.option("--dry-run", is_flag=True, help="Only list what would be deleted.")
+def gc_images(dry_run):
+    """Rename legacy uploads to hashed names and delete unreferenced images."""
+    if os.path.realpath(db.DB_PATH) != os.path.realpath(images.OWNER_DB):
+        raise click.ClickException(f"{db.DB_PATH} does not own {images.IMAGE_ROOT}; set BOUTIQUE_IMAGES with BOUTIQUE_DB")
+    with closing(db.connect()) as conn:
+        if not dry_run:
+            click.echo(f"Adopted {images.adopt_legacy(conn)} product image(s)")
+        removed = images.collect_garbage(conn, dry_run=dry_run)
+    tasks.join()
+    for name in removed:
+        click.echo(name)
+    click.echo(f"{'Would remove' if dry_run else 'Removed'} {len(removed)} file(s)")
+
+
+@app.cli.command("rebuild-rollups")
+@click.option("--check", is_flag=True, help="Only compare against a fresh rebuild; leave the tables alone.")
+def rebuild_rollups(check):
+    """Regenerate the sales rollup tables from orders/order_items."""
+    with closing(db.connect()) as conn:
+        diffs = reports.rebuild(conn, check_only=check)
+    for table, count in diffs.items():
+        click.echo(f"{table}: {count} row(s) differed")
+    if check and any(diffs.values()):
+        raise SystemExit(1)
+
+
 @app.route("/test")
 def test():
     return render_template("test.html")
@@ -758,6 +1176,30 @@ def debug():
     }
 
 
+@app.route("/debug/queries", methods=["GET"])
+def debug_queries():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin"))
+    offenders, recent = slowlog.top()
+    recent = [(datetime.fromtimestamp(when).strftime("%H:%M:%S"), route, ms, sql) for when, route, ms, sql in recent]
+    return render_template(
+        "debug_queries.html",
+        offenders=offenders,
+        recent=recent,
+        lock_waits=slowlog.lock_waits(),
+        threshold_ms=slowlog.SLOW_QUERY_MS,
+    )
+
+
+@app.route("/debug/queries/reset", methods=["POST"])
+def debug_queries_reset():
+    if not session.get("is_admin"):
+        return redirect(url_for("admin"))
+    slowlog.reset()
+    flash("Registro de consultas lentas vaciado.")
+    return redirect(url_for("debug_queries"))
+
+
 @app.route("/gracias")
 def gracias():
     receipt_param = request.args.get("receipt", "[]")
@@ -785,58 +1227,51 @@ def gracias():
     return render_template("gracias.html", receipt=formatted_receipt)
 
 
-@app.route("/inventory/update_positions", methods=["POST"])
-def update_inventory_positions():
-    if not session.get("is_admin"):
-        return "Unauthorized", 403
-    
-    data = request.get_json()
-    positions = data.get("positions", [])
-    
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    try:
-        for item in positions:
-            product_id = item.get("id")
-            position = item.get("position")
-            if product_id and position:
-                c.execute("UPDATE products SET position = ? WHERE id = ?", (position, product_id))
-        
-        conn.commit()
-        return {"status": "success"}, 200
-    except Exception as e:
-        conn.rollback()
-        return {"status": "error", "message": str(e)}, 500
-    finally:
-        conn.close()
+def load_receipt(order_id):
+    receipt = receipts.load(get_db(), order_id)
+    if receipt is None:
+        abort(404)
+    return receipt
 
 
-@app.route("/manage/update_positions", methods=["POST"])
-def update_manage_positions():
-    if not session.get("is_admin"):
-        return "Unauthorized", 403
-    
-    data = request.get_json()
-    positions = data.get("positions", [])
-    
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    try:
-        for item in positions:
-            product_id = item.get("id")
-            position = item.get("position")
-            if product_id and position:
-                c.execute("UPDATE products SET position = ? WHERE id = ?", (position, product_id))
-        
-        conn.commit()
-        return {"status": "success"}, 200
-    except Exception as e:
-        conn.rollback()
-        return {"status": "error", "message": str(e)}, 500
-    finally:
-        conn.close()
+def receipt_order_id(token):
+    order_id = receipts.order_id(token, app.secret_key)
+    if order_id is None:
+        abort(404)
+    return order_id
+
+
+@app.route("/gracias/<token>")
+def order_receipt(token):
+    order_id = receipt_order_id(token)
+
+    def render():
+        receipt = load_receipt(order_id)
+        return render_template(
+            "gracias.html",
+            receipt=receipt.lines,
+            order_id=receipt.order_id,
+            token=token,
+            created_at=receipt.created_at,
+            total=receipt.total,
+        )
+
+    # The page header differs for admins
+    name = ("receipt", order_id, bool(session.get("is_admin")))
+    return pagecache.cached(name, db.version(receipts.VERSION_KEY), render)
+
+
+@app.route("/gracias/<token>.txt")
+def order_ticket(token):
+    order_id = receipt_order_id(token)
+    # Plain text for the thermal printer
+    return pagecache.cached(
+        ("ticket", order_id),
+        db.version(receipts.VERSION_KEY),
+        lambda: receipts.as_text(load_receipt(order_id)),
+        mimetype="text/plain",
+    )
+
 
 from flask import render_template_string
 import os
@@ -889,16 +1324,13 @@ def debug_upload_route():
                 filename = secure_filename(image.filename)
                 
                 # --- A. FIND PATHS ---
-                # Get the folder where app.py lives
-                base_dir = os.path.dirname(os.path.abspath(__file__))
-                
-                # Target: static/images
-                save_folder = os.path.join(base_dir, 'static', 'images')
+                # Target: static/images (or BOUTIQUE_IMAGES)
+                save_folder = images.IMAGE_ROOT
                 
                 # Create folder if missing
                 if not os.path.exists(save_folder):
                     os.makedirs(save_folder)
-                    print(f"DEBUG: Created directory {save_folder}")
+                    app.logger.debug("Created directory %s", save_folder)
 
                 # --- B. SAVE TO DISK ---
                 # Use system separators (\ on Windows, / on Android)
@@ -916,5 +1348,20 @@ def debug_upload_route():
 
     return render_template_string(html_template, msg=msg, err=err)
 
+def warm_up():
+    """Load the catalog snapshot and stock, and compile every template before the first customer.
+
+    gunicorn.conf.py runs this in the master when the app is preloaded, so
+    the workers fork with it already in (shared) memory. It leaves a
+    connection in the pool; close it with db.close_pool() before forking.
+    """
+    with app.app_context():
+        catalog.snapshot()
+        catalog.stock()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    # Development server; the shop itself runs under gunicorn (FIRST STEP.sh)
+    app.run(host='0.0.0.0', port=5000, threaded=True)
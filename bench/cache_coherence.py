@@ -0,0 +1,136 @@
+"""Two worker processes sharing one DB file must never serve a stale catalog.
+
+    python -m bench.cache_coherence
+
+Process A warms its catalog snapshot, process B writes through the normal
+routes, and A must see each change on its very next request. Finally the DB
+file is replaced the way UPDATE.sh does it: with a write still in the WAL,
+the workers stop, the WAL is checkpointed, the file is renamed over with its
+-wal/-shm left alone (as git pull would), and a new pair of workers must see
+exactly the replacement, intact. Exits 1 on the first stale read.
+"""
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+
+
+SOURCE_DB = "Databases/boutique.db"
+
+
+def make_db(path):
+    src = sqlite3.connect(SOURCE_DB)
+    dst = sqlite3.connect(path)
+    src.backup(dst)
+    src.close()
+    dst.execute("DELETE FROM products")
+    dst.commit()
+    dst.close()
+
+
+def worker(db_file, pipe):
+    os.environ["BOUTIQUE_DB"] = db_file
+    import db
+    from app import app
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+    while True:
+        cmd, arg = pipe.recv()
+        if cmd == "stop":
+            # What gunicorn's worker_exit hook does
+            db.close_pool()
+            return
+        if cmd == "add":
+            client.post("/manage/add_product", data={"name": arg, "price": "10", "category_id": "1"})
+        elif cmd == "delete":
+            client.post("/products/delete", data={"name": arg})
+        names = sorted(p[1] for p in client.get("/debug").get_json()["products"])
+        pipe.send(names)
+
+
+def main():
+    tmp = tempfile.mkdtemp(prefix="boutique-coherence-")
+    db_file = os.path.join(tmp, "boutique.db")
+    # The workers add and delete products: keep their uploads and background
+    # jobs away from the shop's static/images
+    os.environ["BOUTIQUE_IMAGES"] = os.path.join(tmp, "images")
+    os.environ["BOUTIQUE_TASKS"] = "0"
+    make_db(db_file)
+
+    ctx = multiprocessing.get_context("spawn")
+    procs = []
+
+    def start():
+        pipes = []
+        for _ in range(2):
+            parent, child = ctx.Pipe()
+            proc = ctx.Process(target=worker, args=(db_file, child), daemon=True)
+            proc.start()
+            pipes.append(parent)
+            procs.append(proc)
+        return pipes
+
+    def stop(pipes):
+        for pipe in pipes:
+            pipe.send(("stop", None))
+        for proc in procs:
+            proc.join(timeout=10)
+
+    def ask(pipe, cmd, arg=None):
+        pipe.send((cmd, arg))
+        return pipe.recv()
+
+    failures = []
+
+    def expect(label, got, want):
+        status = "ok" if got == want else "STALE"
+        print(f"{status:5} {label}: {got}")
+        if got != want:
+            failures.append(label)
+
+    a, b = start()
+    expect("A warm", ask(a, "get"), [])
+    expect("B adds Uno", ask(b, "add", "Uno"), ["Uno"])
+    expect("A after B add", ask(a, "get"), ["Uno"])
+    expect("A adds Dos", ask(a, "add", "Dos"), ["Dos", "Uno"])
+    expect("B after A add", ask(b, "get"), ["Dos", "Uno"])
+    expect("B deletes Uno", ask(b, "delete", "Uno"), ["Dos"])
+    expect("A after B delete", ask(a, "get"), ["Dos"])
+    # Left in the WAL: the swap below must not carry it into the new file
+    expect("B adds Tres", ask(b, "add", "Tres"), ["Dos", "Tres"])
+
+    # UPDATE.sh: stop the server, checkpoint, then git pull renames the pulled
+    # file over the DB without touching -wal/-shm
+    replacement = os.path.join(tmp, "replacement.db")
+    make_db(replacement)
+    conn = sqlite3.connect(replacement)
+    conn.execute("INSERT INTO products (name, price, category_id) VALUES ('Swapped', 1, 1)")
+    conn.commit()
+    conn.close()
+    stop([a, b])
+    sqlite3.connect(db_file).execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    os.replace(replacement, db_file)
+
+    a, b = start()
+    expect("A after file swap", ask(a, "get"), ["Swapped"])
+    expect("B after file swap", ask(b, "get"), ["Swapped"])
+    expect("B adds Cuatro", ask(b, "add", "Cuatro"), ["Cuatro", "Swapped"])
+    expect("A after B add", ask(a, "get"), ["Cuatro", "Swapped"])
+    stop([a, b])
+    check = sqlite3.connect(db_file).execute("PRAGMA integrity_check").fetchone()[0]
+    expect("integrity after swap", check, "ok")
+
+    shutil.rmtree(tmp, ignore_errors=True)
+    if failures:
+        print(f"FAIL: {len(failures)} stale read(s)", file=sys.stderr)
+        return 1
+    print("OK: both workers stayed coherent")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
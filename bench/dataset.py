@@ -0,0 +1,135 @@
+"""Synthetic shop databases of a given size for the benchmarks.
+
+    python -m bench.dataset --size medium /tmp/boutique-medium.db
+    python -m bench.dataset --products 5000 --orders 250000 /tmp/custom.db
+
+Builds the migrated schema and fills it with categories, products and a
+year of orders (1-4 lines each, the odd discount), then backfills the sales
+rollups and runs ANALYZE, so the result looks like a shop that has been
+trading for a while. The same seed always gives the same data.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from itertools import islice
+
+# name -> (products, orders)
+SIZES = {
+    "small": (1_000, 10_000),
+    "medium": (10_000, 100_000),
+    "large": (100_000, 1_000_000),
+}
+PRODUCTS_PER_CATEGORY = 50
+DAYS_OF_HISTORY = 365
+CHUNK = 50_000
+
+
+def _chunks(rows, size=CHUNK):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def make_db(path, products, orders, seed=1):
+    """Create path (which must not exist) with the given number of products and orders."""
+    import migrations
+    import ordering
+    import reports
+
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = OFF")
+    migrations.migrate(conn)
+
+    categories = max(1, min(200, products // PRODUCTS_PER_CATEGORY))
+    conn.executemany(
+        "INSERT INTO categories (id, name, position) VALUES (?, ?, ?)",
+        [(i, f"Categoria {i}", i * ordering.POSITION_GAP) for i in range(1, categories + 1)],
+    )
+    catalog = []
+    for pid in range(1, products + 1):
+        category_id = rnd.randint(1, categories)
+        catalog.append((pid, f"Producto {pid}", rnd.randrange(10, 500, 5), category_id))
+    conn.executemany(
+        "INSERT INTO products (id, name, price, image, position, category_id, inventory) VALUES (?, ?, ?, '', ?, ?, ?)",
+        [(pid, name, price, pid * ordering.POSITION_GAP, category_id, 1_000_000) for pid, name, price, category_id in catalog],
+    )
+    conn.commit()
+
+    # Orders spread over the last year, oldest first so ids follow created_at
+    now = datetime.now(timezone.utc).replace(microsecond=0)
+    start = now - timedelta(days=DAYS_OF_HISTORY)
+    step = (DAYS_OF_HISTORY * 86400) / max(orders, 1)
+    popular = catalog[: max(1, len(catalog) // 5)]
+
+    def order_rows():
+        for order_id in range(1, orders + 1):
+            created_at = (start + timedelta(seconds=order_id * step)).strftime("%Y-%m-%d %H:%M:%S")
+            lines = []
+            # Most sales come from a fifth of the catalog
+            for pid, name, price, category_id in rnd.sample(popular if rnd.random() < 0.8 else catalog, k=min(rnd.randint(1, 4), len(popular))):
+                qty = rnd.randint(1, 3)
+                discount = rnd.choice((0, 0, 0, 0, 10, 25))
+                lines.append((order_id, pid, name, f"Categoria {category_id}", price, qty,
+                              price * qty * (100 - discount) // 100, discount))
+            yield (order_id, created_at, sum(line[6] for line in lines)), lines
+
+    for chunk in _chunks(order_rows()):
+        conn.executemany("INSERT INTO orders (id, created_at, total) VALUES (?, ?, ?)", [order for order, _ in chunk])
+        conn.executemany(
+            """
+            INSERT INTO order_items (order_id, product_id, product_name, category_name, unit_price, quantity, line_total, discount_percent)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [line for _, lines in chunk for line in lines],
+        )
+    conn.commit()
+
+    conn.execute("BEGIN IMMEDIATE")
+    reports.rebuild_tables(conn)
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def copy_db(src, dst):
+    """Copy the DB at src to dst through SQLite's backup API."""
+    source = sqlite3.connect(src)
+    target = sqlite3.connect(dst)
+    source.backup(target)
+    source.close()
+    target.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path")
+    parser.add_argument("--size", choices=SIZES, default="small")
+    parser.add_argument("--products", type=int, help="overrides --size")
+    parser.add_argument("--orders", type=int, help="overrides --size")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    if os.path.exists(args.path):
+        print(f"{args.path} already exists", file=sys.stderr)
+        return 1
+    products, orders = SIZES[args.size]
+    products = args.products or products
+    orders = args.orders if args.orders is not None else orders
+    started = time.perf_counter()
+    make_db(args.path, products, orders, args.seed)
+    print(f"{args.path}: {products} products, {orders} orders in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+"""Concurrent checkout stress run against a throwaway bench.dataset DB.
+
+    python -m bench.purchase_stress --threads 8 --products 5 --stock 50
+    python -m bench.purchase_stress --db /tmp/boutique-large.db  # reuse a bench.dataset DB
+
+Several registers hammer /api/purchase for a handful of low-stock products
+(the first --products of the catalog, each set to --stock units). The run
+fails (exit 1) if any product is oversold or ends up negative, and prints
+orders/second under contention.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from bench import dataset
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--products", type=int, default=5)
+    parser.add_argument("--stock", type=int, default=50)
+    parser.add_argument("--attempts", type=int, default=0, help="checkouts per thread (default: enough to sell out twice)")
+    parser.add_argument("--db", help="existing bench.dataset DB to copy instead of generating one")
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix="boutique-stress-")
+    db_file = os.path.join(tmp, "boutique.db")
+    # Before anything imports db, which reads the path once
+    os.environ["BOUTIQUE_DB"] = db_file
+    if args.db:
+        dataset.copy_db(args.db, db_file)
+    else:
+        dataset.make_db(db_file, args.products, 0)
+    # Only the first --products products are sold, and orders already in a
+    # copied DB are left out of the count
+    conn = sqlite3.connect(db_file)
+    pids = [pid for (pid,) in conn.execute("SELECT id FROM products ORDER BY id LIMIT ?", (args.products,))]
+    conn.executemany("UPDATE products SET inventory = ? WHERE id = ?", [(args.stock, pid) for pid in pids])
+    first_order = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+    conn.commit()
+    conn.close()
+    from app import app
+
+    attempts = args.attempts or max(1, (len(pids) * args.stock * 2) // args.threads)
+    counts = {"ok": 0, "conflict": 0, "error": 0}
+    lock = threading.Lock()
+    start_gate = threading.Barrier(args.threads)
+
+    def register(seed):
+        rnd = random.Random(seed)
+        client = app.test_client()
+        local = {"ok": 0, "conflict": 0, "error": 0}
+        start_gate.wait()
+        for _ in range(attempts):
+            picks = rnd.sample(pids, k=min(2, len(pids)))
+            items = [{"product_id": pid, "qty": rnd.randint(1, 2)} for pid in picks]
+            res = client.post("/api/purchase", json={"items": items})
+            if res.status_code == 200:
+                local["ok"] += 1
+            elif res.status_code == 409:
+                local["conflict"] += 1
+            else:
+                local["error"] += 1
+        with lock:
+            for key, val in local.items():
+                counts[key] += val
+
+    threads = [threading.Thread(target=register, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    conn = sqlite3.connect(db_file)
+    sold = dict(conn.execute("SELECT product_id, SUM(quantity) FROM order_items WHERE order_id > ? GROUP BY product_id", (first_order,)))
+    stock = dict(conn.execute(f"SELECT id, inventory FROM products WHERE id IN ({','.join('?' * len(pids))})", pids))
+    orders = conn.execute("SELECT COUNT(*) FROM orders WHERE id > ?", (first_order,)).fetchone()[0]
+    conn.close()
+
+    oversold = [
+        pid for pid, left in stock.items()
+        if left < 0 or left + sold.get(pid, 0) != args.stock
+    ]
+    total = sum(counts.values())
+    print(f"threads={args.threads} checkouts={total} ok={counts['ok']} conflict={counts['conflict']} error={counts['error']}")
+    print(f"orders recorded={orders} units sold={sum(sold.values())} of {len(pids) * args.stock}")
+    print(f"{total / elapsed:.1f} checkouts/s, {counts['ok'] / elapsed:.1f} orders/s over {elapsed:.2f}s")
+    if oversold or orders != counts["ok"] or counts["error"]:
+        print(f"FAIL: oversold products {oversold}", file=sys.stderr)
+        return 1
+    print("OK: no oversells")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
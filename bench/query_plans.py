@@ -0,0 +1,145 @@
+"""The hot queries must be answered from the indexes migrations.py creates.
+
+    python -m bench.query_plans
+    python -m bench.query_plans --db /tmp/boutique-large.db  # reuse a bench.dataset DB
+
+Runs EXPLAIN QUERY PLAN on a bench.dataset database (a small one built in a
+temp dir unless --db is given) for the queries behind the chart, the
+product-name checks of the editors and the import, receipts, and every
+rollup read of the reports. Exits 1 if one of them falls back to a full
+table scan instead of its index.
+
+The app's own queries must not sort in a temp B-tree either: a chart page
+that has to sort its whole date range first costs more the wider the range,
+however small the LIMIT. The rollup reads may sort; they only ever see the
+few hundred buckets of their range.
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+import analytics
+import reports
+from bench import dataset
+
+
+# name -> (SQL as the app runs it, parameters, index that must appear in the plan)
+QUERIES = {
+    "chart page": (
+        """
+        WITH page AS (
+            SELECT id, created_at, total FROM orders
+            WHERE created_at >= ? AND created_at < ? AND (? IS NULL OR (created_at, id) < (?, ?))
+            ORDER BY created_at DESC, id DESC
+            LIMIT ?
+        )
+        SELECT page.id, page.created_at, page.total, oi.id,
+               oi.product_name, oi.category_name, oi.unit_price, oi.quantity, oi.line_total, oi.discount_percent
+        FROM page LEFT JOIN order_items oi ON oi.order_id = page.id
+        """,
+        ("{month_ago}", "{tomorrow}", "{week_ago} 12:00:00", "{week_ago} 12:00:00", 5000, 51),
+        "idx_orders_created_at",
+    ),
+    "duplicate product name": (
+        "SELECT id FROM products WHERE LOWER(name) = ? AND id != ?",
+        ("producto 17", 17),
+        "idx_products_lower_name",
+    ),
+    "names taken by a bulk update": (
+        "SELECT id, name FROM products WHERE LOWER(name) IN (?,?,?)",
+        ("producto 17", "producto 18", "producto 19"),
+        "idx_products_lower_name",
+    ),
+    "products matched by an import": (
+        """
+        SELECT p.id, p.name, p.price, c.name, p.inventory FROM products p LEFT JOIN categories c ON c.id = p.category_id
+        WHERE LOWER(p.name) IN (?,?,?)
+        """,
+        ("producto 17", "producto 18", "producto 19"),
+        "idx_products_lower_name",
+    ),
+    "next position in a category": (
+        "SELECT MAX(position) FROM products WHERE category_id = ?",
+        (3,),
+        "idx_products_category_position",
+    ),
+    "receipt lines": (
+        """
+        SELECT product_name, COALESCE(NULLIF(category_name, ''), 'Unknown'), quantity, unit_price,
+               COALESCE(discount_percent, 0), line_total
+        FROM order_items WHERE order_id = ? ORDER BY id
+        """,
+        (42,),
+        "idx_order_items_order_id",
+    ),
+}
+
+
+def rollup_reads(conn, start, end):
+    """[(name, SQL)] of what reports and analytics run for start..end, as executed."""
+    reads = {"period totals": lambda: reports.period_totals(conn, start, end)}
+    for name, run in analytics.REPORTS.items():
+        reads[f"{name} report"] = lambda run=run: run(conn, start, end, analytics.DEFAULT_LIMIT)
+    statements = []
+    try:
+        for name, read in reads.items():
+            conn.set_trace_callback(lambda sql, name=name: statements.append((name, sql)))
+            read()
+    finally:
+        conn.set_trace_callback(None)
+    return statements
+
+
+def explain(conn, sql, params=()):
+    return [row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+
+def report(name, ok, plan):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    for step in plan:
+        print(f"       {step}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", help="existing bench.dataset DB to check instead of generating one")
+    args = parser.parse_args(argv)
+
+    tmp = None
+    db_file = args.db
+    if db_file is None:
+        tmp = tempfile.mkdtemp(prefix="boutique-plans-")
+        db_file = os.path.join(tmp, "boutique.db")
+        dataset.make_db(db_file, *dataset.SIZES["small"])
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+
+    today = datetime.now(timezone.utc).date()
+    days = {
+        "month_ago": (today - timedelta(days=30)).isoformat(),
+        "week_ago": (today - timedelta(days=7)).isoformat(),
+        "tomorrow": (today + timedelta(days=1)).isoformat(),
+    }
+    failed = False
+    for name, (sql, params, index) in QUERIES.items():
+        params = tuple(p.format(**days) if isinstance(p, str) else p for p in params)
+        plan = explain(conn, sql, params)
+        ok = any(index in step for step in plan) and not any("TEMP B-TREE" in step for step in plan)
+        failed |= not report(name, ok, plan)
+    # Rollup tables are WITHOUT ROWID: their index is the primary key
+    for name, sql in rollup_reads(conn, days["month_ago"], today.isoformat()):
+        plan = explain(conn, sql)
+        ok = any("USING PRIMARY KEY" in step for step in plan)
+        failed |= not report(name, ok, plan)
+    conn.close()
+    if tmp:
+        shutil.rmtree(tmp, ignore_errors=True)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+"""Replay the shop's recorded traffic against a copy of its database.
+
+    python -m bench.replay flask.log nohup.out --speed 5 --concurrency 4
+    python -m bench.replay nohup.out --speed 20 --db /tmp/shop.db
+
+The shop's own DB may have nothing in stock; a bench.dataset DB (python -m
+bench.dataset --size small /tmp/shop.db) gives the purchases something to sell.
+
+Reads access logs (the werkzeug lines in flask.log / nohup.out, or gunicorn's
+common log format), strips the terminal colours and turns every request into
+a workload entry at its original time offset. Routes that have since been
+renamed are mapped to their current equivalent (/checkout -> /api/purchase,
+/del_order -> /orders/delete, /update -> /products/bulk_update, GET
+/products -> /manage). The logs carry no request bodies, so POSTs get
+synthetic ones built from the copied DB: carts of in-stock products, the
+newest orders to delete, and so on.
+
+The workload runs through the Flask test client from --concurrency threads
+at --speed times the recorded pace (0 = as fast as possible). Idle stretches
+longer than --max-gap seconds are shortened to it first, so a log spanning
+several days still replays in minutes. The replay writes as heavily as the
+shop did (sales, edits, deletes), so it runs on a copy of the DB in a temp
+directory, with uploads pointed at a temp folder (BOUTIQUE_IMAGES) and
+background jobs off (BOUTIQUE_TASKS=0): the source DB and static/images are
+never touched (replayed image GETs find the temp folder empty; --no-static
+leaves them out). Reports throughput, p50/p99 latency per route, how far
+requests fell behind schedule, and "database is locked" errors.
+"""
+import argparse
+import os
+import queue
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from bench.routes import percentile
+
+ANSI = re.compile(r"\x1b\[[0-9;]*m")
+# werkzeug: 127.0.0.1 - - [03/Jul/2025 12:42:22] "GET / HTTP/1.1" 200 -
+# gunicorn: 127.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET / HTTP/1.1" 200 512 ...
+ACCESS_LINE = re.compile(r'\[(?P<when>[^\]]+)\] "(?P<method>[A-Z]+) (?P<path>\S+) HTTP/[\d.]+" (?P<status>\d{3})')
+TIME_FORMATS = ("%d/%b/%Y %H:%M:%S", "%d/%b/%Y:%H:%M:%S %z")
+
+# (method, old path) -> (method, current path)
+LEGACY_ROUTES = {
+    ("POST", "/checkout"): ("POST", "/api/purchase"),
+    ("POST", "/del_order"): ("POST", "/orders/delete"),
+    ("POST", "/update"): ("POST", "/products/bulk_update"),
+    ("GET", "/products"): ("GET", "/manage"),
+}
+
+
+class Entry:
+    def __init__(self, offset, method, path, logged_status):
+        # Seconds since the first request, after gap compression
+        self.offset = offset
+        self.method = method
+        self.path = path
+        self.logged_status = logged_status
+
+    @property
+    def route(self):
+        """Path without query string, numbers folded, for grouping results."""
+        return f"{self.method} " + re.sub(r"/\d+(?=/|$)", "/<id>", self.path.split("?", 1)[0])
+
+
+def _parse_time(text):
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).replace(tzinfo=None)
+        except ValueError:
+            continue
+    return None
+
+
+def parse(paths, max_gap=30.0, static=True):
+    """Workload entries from access logs, in time order."""
+    hits = []
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            for line in f:
+                match = ACCESS_LINE.search(ANSI.sub("", line))
+                if not match:
+                    continue
+                when = _parse_time(match["when"])
+                if when is None:
+                    continue
+                method, target = LEGACY_ROUTES.get((match["method"], match["path"]), (match["method"], match["path"]))
+                if not static and target.startswith("/static/"):
+                    continue
+                hits.append((when, method, target, int(match["status"])))
+    hits.sort(key=lambda hit: hit[0])
+    entries = []
+    offset = 0.0
+    previous = None
+    for when, method, target, status in hits:
+        if previous is not None:
+            offset += min((when - previous).total_seconds(), max_gap)
+        previous = when
+        entries.append(Entry(offset, method, target, status))
+    return entries
+
+
+class Shop:
+    """Synthetic request bodies, drawn from (and kept in step with) the copied DB."""
+
+    def __init__(self, db_file, seed=1):
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        conn = sqlite3.connect(db_file)
+        self.products = conn.execute("SELECT id, name, price, position FROM products WHERE inventory > 0").fetchall()
+        self.orders = [row[0] for row in conn.execute("SELECT id FROM orders ORDER BY id")]
+        conn.close()
+        self.added = []
+        self.counter = 0
+
+    def purchase(self):
+        if not self.products:
+            return None
+        with self.lock:
+            picks = self.rnd.sample(self.products, k=min(self.rnd.randint(1, 3), len(self.products)))
+        return {"json": {"items": [{"product_id": row[0], "qty": 1} for row in picks]}}
+
+    def purchased(self, response):
+        if response.is_json and response.get_json().get("order_id"):
+            with self.lock:
+                self.orders.append(response.get_json()["order_id"])
+
+    def delete_order(self):
+        with self.lock:
+            order_id = self.orders.pop() if self.orders else 0
+        return {"data": {"order_id": str(order_id)}}
+
+    def bulk_update(self):
+        if not self.products:
+            return None
+        with self.lock:
+            rows = self.rnd.sample(self.products, k=min(5, len(self.products)))
+        return {"data": {
+            "id": [str(row[0]) for row in rows],
+            "name": [row[1] for row in rows],
+            "price": [str(row[2]) for row in rows],
+            "position": [str(row[3]) for row in rows],
+        }}
+
+    def add_product(self):
+        with self.lock:
+            self.counter += 1
+            name = f"Replay {self.counter}"
+            self.added.append(name)
+        return {"data": {"name": name, "price": "100"}}
+
+    def delete_product(self):
+        # Only what the replay itself added; otherwise a no-op delete
+        with self.lock:
+            name = self.added.pop(0) if self.added else "Replay missing"
+        return {"data": {"name": name}}
+
+    def body(self, method, path):
+        """Request kwargs for the test client, or None for a POST we can't fake.
+
+        None also when the DB has nothing for it to act on (no stock to sell).
+        """
+        if method != "POST":
+            return {}
+        route = path.split("?", 1)[0]
+        make = {
+            "/api/purchase": self.purchase,
+            "/orders/delete": self.delete_order,
+            "/products/bulk_update": self.bulk_update,
+            "/inventory/bulk_update": self.bulk_update,
+            "/products/add": self.add_product,
+            "/products/delete": self.delete_product,
+        }.get(route)
+        return make() if make else None
+
+
+def replay(entries, db_file, speed=1.0, concurrency=4):
+    """Run entries against db_file; returns per-request results and the wall time.
+
+    BOUTIQUE_DB (and BOUTIQUE_IMAGES) must already be set when db and
+    images are first imported.
+    """
+    from flask import got_request_exception
+
+    from app import app
+
+    shop = Shop(db_file)
+    if not shop.products:
+        print("warning: no products in stock; purchases and bulk updates are skipped", file=sys.stderr)
+    results = []
+    lock_errors = []
+    results_lock = threading.Lock()
+
+    def on_exception(sender, exception, **extra):
+        if isinstance(exception, sqlite3.OperationalError) and ("locked" in str(exception) or "busy" in str(exception)):
+            with results_lock:
+                lock_errors.append(str(exception))
+
+    got_request_exception.connect(on_exception, app)
+    work = queue.Queue()
+
+    def worker():
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess["is_admin"] = True
+        while True:
+            item = work.get()
+            if item is None:
+                return
+            entry, scheduled, kwargs = item
+            started = time.perf_counter()
+            response = client.open(entry.path, method=entry.method, **kwargs)
+            elapsed = time.perf_counter() - started
+            if entry.path.startswith("/api/purchase"):
+                shop.purchased(response)
+            response.close()
+            with results_lock:
+                results.append((entry, response.status_code, elapsed, max(0.0, started - scheduled)))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    skipped = 0
+    began = time.perf_counter()
+    for entry in entries:
+        kwargs = shop.body(entry.method, entry.path)
+        if kwargs is None:
+            skipped += 1
+            continue
+        scheduled = began + (entry.offset / speed if speed else 0)
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        work.put((entry, scheduled if speed else time.perf_counter(), kwargs))
+    for _ in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    got_request_exception.disconnect(on_exception, app)
+    return results, lock_errors, skipped, time.perf_counter() - began
+
+
+def report(results, lock_errors, skipped, wall):
+    latencies = [elapsed * 1000 for _, _, elapsed, _ in results]
+    lags = [lag * 1000 for _, _, _, lag in results]
+    errors = sum(1 for _, status, _, _ in results if status >= 500)
+    print(f"requests={len(results)} skipped={skipped} wall={wall:.1f}s throughput={len(results) / wall:.1f} req/s")
+    if results:
+        print(f"latency p50={percentile(latencies, 50):.1f} ms p99={percentile(latencies, 99):.1f} ms"
+              f" max={max(latencies):.1f} ms; behind schedule p99={percentile(lags, 99):.1f} ms max={max(lags):.1f} ms")
+    print(f"5xx={errors} database locked={len(lock_errors)}")
+    by_route = {}
+    for entry, status, elapsed, _ in results:
+        by_route.setdefault(entry.route, []).append((status, elapsed * 1000))
+    print(f"{'route':<40} {'count':>6} {'p50 ms':>8} {'p99 ms':>8} {'5xx':>5}")
+    for route, hits in sorted(by_route.items(), key=lambda item: -len(item[1])):
+        times = [ms for _, ms in hits]
+        print(f"{route[:40]:<40} {len(hits):>6} {percentile(times, 50):>8.1f} {percentile(times, 99):>8.1f}"
+              f" {sum(1 for status, _ in hits if status >= 500):>5}")
+    return 1 if lock_errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("logs", nargs="+", help="access logs (flask.log, nohup.out, ...)")
+    parser.add_argument("--db", default="Databases/boutique.db", help="DB to copy for the replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="1, 5, 20... times the recorded pace; 0 = flat out")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--max-gap", type=float, default=30.0, help="longest idle stretch kept, in log seconds")
+    parser.add_argument("--no-static", action="store_true", help="leave out /static/ requests")
+    args = parser.parse_args(argv)
+
+    entries = parse(args.logs, args.max_gap, static=not args.no_static)
+    if not entries:
+        print("no access log lines found", file=sys.stderr)
+        return 1
+    span = entries[-1].offset / args.speed if args.speed else 0
+    print(f"workload: {len(entries)} requests, {entries[-1].offset:.0f}s of log time"
+          + (f", about {span:.0f}s at {args.speed:g}x" if args.speed else ", flat out"))
+
+    tmp = tempfile.mkdtemp(prefix="boutique-replay-")
+    db_file = os.path.join(tmp, "boutique.db")
+    src = sqlite3.connect(args.db)
+    dst = sqlite3.connect(db_file)
+    src.backup(dst)
+    src.close()
+    dst.close()
+    # Before anything imports db, which reads the path once
+    os.environ["BOUTIQUE_DB"] = db_file
+    os.environ["BOUTIQUE_IMAGES"] = os.path.join(tmp, "images")
+    os.environ["BOUTIQUE_TASKS"] = "0"
+    os.environ.setdefault("BOUTIQUE_SLOW_QUERY_MS", "1e9")
+    try:
+        return report(*replay(entries, db_file, args.speed, args.concurrency))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+"""Latency and query counts of the main routes on a synthetic shop.
+
+    python -m bench.routes --size small                 # compare with the baseline
+    python -m bench.routes --size small --save-baseline # record a new baseline
+    python -m bench.routes --db /tmp/boutique-large.db  # reuse a bench.dataset DB
+
+Drives index, inventory, manage, chart, api_purchase and bulk_update through
+the Flask test client against a bench.dataset database (built in a temp
+directory unless --db is given; a given DB is copied, never written). For
+each route it prints p50/p95/p99 latency and the SQL statements per request.
+
+Baselines are kept per dataset in bench/baseline.json. The run exits 1 when
+a route's p50 or p95 is more than --tolerance times its baseline, or it runs
+more statements per request than before, and 2 when there is no baseline
+for the dataset yet. Latencies only compare on the machine that recorded
+them, so record the baseline on the tablet itself (it is not committed).
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+from bench import dataset
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Ignore latency regressions smaller than this; timer noise on fast routes
+MIN_REGRESSION_MS = 2.0
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def scenarios(db_file, rnd):
+    """name -> (unmeasured setup or None, measured request); both take the client."""
+    conn = sqlite3.connect(db_file)
+    product_ids = [row[0] for row in conn.execute("SELECT id FROM products")]
+    busiest = conn.execute(
+        "SELECT category_id FROM products GROUP BY category_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()[0]
+    editable = conn.execute(
+        "SELECT id, name, price, position FROM products WHERE category_id = ? ORDER BY position LIMIT 20",
+        (busiest,),
+    ).fetchall()
+    conn.close()
+    flip = [0]
+
+    def purchase(client):
+        items = [{"product_id": pid, "qty": 1} for pid in rnd.sample(product_ids, k=min(3, len(product_ids)))]
+        return client.post("/api/purchase", json={"items": items})
+
+    def bulk_update(client):
+        # Alternate the prices so every run really writes
+        flip[0] ^= 1
+        return client.post("/products/bulk_update", data={
+            "id": [str(row[0]) for row in editable],
+            "name": [row[1] for row in editable],
+            "price": [str(row[2] + flip[0]) for row in editable],
+            "position": [str(row[3]) for row in editable],
+            "return_category_id": str(busiest),
+        })
+
+    def get(path):
+        return lambda client: client.get(path)
+
+    # Stock isn't on the index page, so after a sale it must still be a cache
+    # hit; a catalog edit is what makes it render again
+    return {
+        "index": (None, get("/")),
+        "index (after a sale)": (purchase, get("/")),
+        "index (after an edit)": (bulk_update, get("/")),
+        "inventory": (None, get("/inventory")),
+        "manage": (None, get("/manage")),
+        "chart": (None, get("/chart")),
+        "api_purchase": (None, purchase),
+        "bulk_update": (None, bulk_update),
+    }
+
+
+def run(db_file, requests, seed=1):
+    """{route: {"p50", "p95", "p99" (ms), "queries" (per request)}}
+
+    BOUTIQUE_DB must already point at db_file when db is first imported.
+    """
+    import db
+    from app import app
+
+    statements = [0]
+    db.query_hooks.append(lambda *args: statements.__setitem__(0, statements[0] + 1))
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess["is_admin"] = True
+
+    results = {}
+    for name, (setup, request) in scenarios(db_file, random.Random(seed)).items():
+        timings = []
+        counts = []
+        for attempt in range(requests + 1):
+            if setup is not None:
+                setup(client)
+            statements[0] = 0
+            started = time.perf_counter()
+            response = request(client)
+            elapsed = time.perf_counter() - started
+            if response.status_code >= 400:
+                raise SystemExit(f"{name}: HTTP {response.status_code}")
+            # The first request warms pools and template caches
+            if attempt:
+                timings.append(elapsed * 1000)
+                counts.append(statements[0])
+        results[name] = {
+            "p50": round(percentile(timings, 50), 2),
+            "p95": round(percentile(timings, 95), 2),
+            "p99": round(percentile(timings, 99), 2),
+            "queries": max(counts),
+        }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Lines describing every regression against baseline (empty if none)."""
+    problems = []
+    for name, now in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for key in ("p50", "p95"):
+            limit = before[key] * tolerance
+            if now[key] > limit and now[key] - before[key] > MIN_REGRESSION_MS:
+                problems.append(f"{name}: {key} {now[key]:.2f} ms > {limit:.2f} ms (baseline {before[key]:.2f})")
+        if now["queries"] > before["queries"]:
+            problems.append(f"{name}: {now['queries']} statements per request, baseline {before['queries']}")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", choices=dataset.SIZES, default="small")
+    parser.add_argument("--products", type=int, help="overrides --size")
+    parser.add_argument("--orders", type=int, help="overrides --size")
+    parser.add_argument("--db", help="existing bench.dataset DB to copy instead of generating one")
+    parser.add_argument("--requests", type=int, default=50, help="measured requests per route")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed slowdown factor")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp(prefix="boutique-bench-")
+    db_file = os.path.join(tmp, "boutique.db")
+    # Before anything imports db, which reads the path once
+    os.environ["BOUTIQUE_DB"] = db_file
+    os.environ.setdefault("BOUTIQUE_SLOW_QUERY_MS", "1e9")
+    if args.db:
+        dataset.copy_db(args.db, db_file)
+        conn = sqlite3.connect(db_file)
+        products, orders = (conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in ("products", "orders"))
+        conn.close()
+    else:
+        products, orders = dataset.SIZES[args.size]
+        products = args.products or products
+        orders = args.orders if args.orders is not None else orders
+        started = time.perf_counter()
+        dataset.make_db(db_file, products, orders)
+        print(f"dataset: {products} products, {orders} orders ({time.perf_counter() - started:.1f}s)")
+
+    try:
+        results = run(db_file, args.requests)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    label = f"{products}x{orders}"
+    print(f"{'route':<22} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'queries':>8}")
+    for name, r in results.items():
+        print(f"{name:<22} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f} {r['queries']:>8}")
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+    if args.save_baseline:
+        baselines[label] = results
+        with open(args.baseline, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline for {label} saved to {args.baseline}")
+        return 0
+    if label not in baselines:
+        # Not a pass: with nothing to compare against, the gate checked nothing
+        print(f"no baseline for {label} in {args.baseline}; record one with --save-baseline", file=sys.stderr)
+        return 2
+    problems = compare(results, baselines[label], args.tolerance)
+    for line in problems:
+        print(f"REGRESSION {line}", file=sys.stderr)
+    if problems:
+        return 1
+    print(f"OK: within {args.tolerance}x of the {label} baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
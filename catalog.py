@@ -0,0 +1,115 @@
+"""In-process snapshot of the catalog (categories + products).
+
+The catalog changes a handful of times a day but is read on every page, so
+readers share one immutable snapshot tagged with the catalog version. Every
+write route calls bump(conn) inside its transaction, which increments the
+meta(catalog_version) row. Each read checks that row cheaply through
+db.version() (a PRAGMA data_version probe), so a write made by any worker
+process, or a DB file replaced on disk, is picked up on the next request.
+Every view (grouped, filtered, flat) is derived from the snapshot without
+going back to SQLite.
+
+Stock is not part of it: every sale changes inventory, and reloading the
+whole catalog in every worker after each sale would defeat the point. Stock
+has its own meta(stock_version), bumped by bump_stock(), and stock() keeps
+just an {id: inventory} map, reloaded by one narrow SELECT when either
+version moves (a new product needs its row in the map too).
+"""
+import re
+import threading
+
+import db
+from db import get_db
+
+
+class Snapshot:
+    def __init__(self, version, categories, products):
+        self.version = version
+        # [(id, name)] in display order
+        self.categories = categories
+        # [(id, name, price, image, category_id)] by position, id
+        self.products = products
+        self.by_id = {p[0]: p for p in products}
+        self.by_category = {}
+        # Full rows per category plus each product's index in the flat list and
+        # in its category list, for keyset paging
+        self.category_rows = {}
+        self.rank = {}
+        self.category_rank = {}
+        for idx, row in enumerate(products):
+            pid, name, price, image, cat_id = row
+            self.by_category.setdefault(cat_id, []).append((pid, name, price, image))
+            rows = self.category_rows.setdefault(cat_id, [])
+            self.rank[pid] = idx
+            self.category_rank[pid] = len(rows)
+            rows.append(row)
+
+
+VERSION_KEY = "catalog_version"
+STOCK_KEY = "stock_version"
+
+_lock = threading.Lock()
+_snapshot = None
+# ((catalog version, stock version), {id: inventory})
+_stock = None
+
+
+def bump(conn):
+    """Mark the catalog as changed; call inside the write's transaction."""
+    db.bump_version(conn, VERSION_KEY)
+
+
+def bump_stock(conn):
+    """Mark inventory as changed (sales, stock received); call inside the write's transaction."""
+    db.bump_version(conn, STOCK_KEY)
+
+
+def name_key(name):
+    """Product name as LOWER(name) sees it, for comparing names in Python.
+
+    SQLite's LOWER() folds ASCII letters only, so "Ñoquis" and "ñoquis" are
+    different names to the DB; str.lower() would call them the same.
+    """
+    return re.sub(r"[A-Z]+", lambda m: m.group().lower(), name)
+
+
+def _load(version):
+    c = get_db().cursor()
+    c.execute("SELECT id, name FROM categories ORDER BY position ASC, name ASC")
+    categories = c.fetchall()
+    c.execute(
+        "SELECT id, name, price, image, category_id FROM products ORDER BY position ASC, id ASC"
+    )
+    products = c.fetchall()
+    return Snapshot(version, categories, products)
+
+
+def snapshot():
+    global _snapshot
+    version = db.version(VERSION_KEY)
+    current = _snapshot
+    if current is not None and current.version == version:
+        return current
+    with _lock:
+        if _snapshot is None or _snapshot.version != version:
+            # The version was read before the rows: a bump that lands mid-load
+            # just triggers one more reload on the next request
+            _snapshot = _load(version)
+        return _snapshot
+
+
+def stock_version():
+    return (db.version(VERSION_KEY), db.version(STOCK_KEY))
+
+
+def stock():
+    """{product id: inventory}, current as of this request."""
+    global _stock
+    version = stock_version()
+    current = _stock
+    if current is not None and current[0] == version:
+        return current[1]
+    with _lock:
+        if _stock is None or _stock[0] != version:
+            _stock = (version, dict(get_db().execute("SELECT id, inventory FROM products")))
+        return _stock[1]
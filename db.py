@@ -0,0 +1,198 @@
+import os
+import queue
+import sqlite3
+import time
+
+from flask import g
+
+
+DB_PATH = os.environ.get("BOUTIQUE_DB", "Databases/boutique.db")
+
+# Connection tuning. cache_size is negative so SQLite reads it as KiB.
+POOL_SIZE = 8
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 16384
+MMAP_SIZE = 64 * 1024 * 1024
+
+META_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+_file_id = None
+# Called with a fresh connection whenever a new DB file is opened (startup or swap)
+_prepare = None
+# Called as hook(conn, sql, parameters, seconds) after every statement
+# (metrics, slow log); parameters is None for executemany()
+query_hooks = []
+
+
+def _observe(conn, sql, parameters, started):
+    elapsed = time.perf_counter() - started
+    for hook in query_hooks:
+        hook(conn, sql, parameters, elapsed)
+
+
+class Cursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe(self.connection, sql, parameters, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe(self.connection, sql, None, started)
+
+
+class Connection(sqlite3.Connection):
+    # Identity of the DB file this connection was opened on
+    file_id = None
+    # Cached meta rows and the PRAGMA data_version they were read at
+    data_version = None
+    meta = None
+
+    # Connection.execute() doesn't go through Cursor.execute(), so both are timed
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _observe(self, sql, parameters, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _observe(self, sql, None, started)
+
+
+def _stat_file(path=None):
+    try:
+        st = os.stat(path or DB_PATH)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino)
+
+
+def connect(path=None):
+    """Open a new connection with the shop's pragmas applied."""
+    conn = sqlite3.connect(
+        path or DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        check_same_thread=False,
+        factory=Connection,
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.file_id = _stat_file(path)
+    return conn
+
+
+def get_db():
+    """Connection for the current request, borrowed from the pool on first use."""
+    global _file_id
+    if "db" not in g:
+        # If the DB file is replaced (a restore copied over it), pooled
+        # connections would keep reading the old inode, so start over when the
+        # file changes. Only safe with the WAL checkpointed away first, which is
+        # why UPDATE.sh stops the server around git pull.
+        file_id = _stat_file()
+        if file_id != _file_id:
+            _file_id = file_id
+            close_pool()
+            prepare()
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = connect()
+        if conn.file_id != file_id:
+            conn.close()
+            conn = connect()
+        g.db = conn
+    return g.db
+
+
+def release_db(exc=None):
+    conn = g.pop("db", None)
+    if conn is None:
+        return
+    # Never hand a half-finished transaction to the next request
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+def close_pool():
+    """Close every pooled connection (e.g. before forking or swapping the DB file)."""
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            return
+        conn.close()
+
+
+def bump_version(conn, key):
+    """Increment a meta counter inside the caller's transaction.
+
+    Other processes notice through PRAGMA data_version on their next read.
+    """
+    conn.execute(
+        "INSERT INTO meta (key, value) VALUES (?, 1) ON CONFLICT (key) DO UPDATE SET value = value + 1",
+        (key,),
+    )
+    # data_version only moves for commits by *other* connections
+    if isinstance(conn, Connection):
+        conn.meta = None
+
+
+def version(key, conn=None):
+    """Cache key for anything derived from the DB: (file identity, meta counter).
+
+    Costs one PRAGMA per call; the meta table is only re-read when some other
+    connection (in this process or another) has committed since last time.
+    """
+    conn = conn or get_db()
+    data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+    if conn.meta is None or data_version != conn.data_version:
+        conn.meta = dict(conn.execute("SELECT key, value FROM meta"))
+        conn.data_version = data_version
+    return (conn.file_id, conn.meta.get(key, 0))
+
+
+def prepare():
+    """Bring the current DB file's schema up to date."""
+    global _file_id
+    conn = connect()
+    try:
+        if _prepare is not None:
+            _prepare(conn)
+    finally:
+        conn.close()
+    _file_id = _stat_file()
+
+
+def init_app(app, prepare_db=None):
+    global _prepare
+    _prepare = prepare_db
+    prepare()
+    app.teardown_appcontext(release_db)
@@ -0,0 +1,88 @@
+"""Order history as CSV or NDJSON, streamed.
+
+The export is one SELECT of orders joined with their lines, walked with a
+cursor a batch at a time and written out as it goes, so memory stays flat
+whether it covers a day or years. Rows come in created_at, id order: that
+is the order of idx_orders_created_at, so SQLite never has to sort (and
+buffer) the result. The single statement also gives a consistent snapshot
+while sales carry on.
+"""
+import csv
+import io
+import json
+from contextlib import closing
+
+import db
+
+# Rows fetched (and lines written) per chunk sent to the client
+BATCH = 500
+
+CSV_COLUMNS = (
+    "order_id", "created_at", "order_total", "product_id", "product_name", "category_name",
+    "unit_price", "quantity", "discount_percent", "line_total",
+)
+
+QUERY = """
+SELECT o.id, o.created_at, o.total, oi.product_id, oi.product_name, oi.category_name,
+       oi.unit_price, oi.quantity, COALESCE(oi.discount_percent, 0), oi.line_total
+FROM orders o LEFT JOIN order_items oi ON oi.order_id = o.id
+WHERE o.created_at >= ? AND o.created_at < ?
+ORDER BY o.created_at, o.id, oi.id
+"""
+
+
+def rows(lo, hi):
+    """Yield batches of (order columns..., line columns...) for lo <= created_at < hi.
+
+    Opens its own connection rather than borrowing the request's pooled one,
+    which would otherwise be tied up (and its snapshot held) for the whole
+    download.
+    """
+    with closing(db.connect()) as conn:
+        cursor = conn.execute(QUERY, (lo, hi))
+        while True:
+            batch = cursor.fetchmany(BATCH)
+            if not batch:
+                return
+            yield batch
+
+
+def as_csv(batches):
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    for batch in batches:
+        writer.writerows(batch)
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+    # Header only, for an empty range
+    if out.tell():
+        yield out.getvalue()
+
+
+def as_ndjson(batches):
+    """One JSON object per order, with its lines in an "items" list."""
+    order = None
+    for batch in batches:
+        chunk = []
+        for order_id, created_at, total, product_id, name, category, unit_price, qty, discount, line_total in batch:
+            if order is None or order["order_id"] != order_id:
+                # Rows arrive grouped by order, so the previous one is complete
+                if order is not None:
+                    chunk.append(json.dumps(order, ensure_ascii=False) + "\n")
+                order = {"order_id": order_id, "created_at": created_at, "total": total, "items": []}
+            if product_id is not None:
+                order["items"].append({
+                    "product_id": product_id,
+                    "product_name": name,
+                    "category_name": category,
+                    "unit_price": unit_price,
+                    "quantity": qty,
+                    "discount_percent": discount,
+                    "line_total": line_total,
+                })
+        if chunk:
+            yield "".join(chunk)
+    if order is not None:
+        yield json.dumps(order, ensure_ascii=False) + "\n"
@@ -0,0 +1,69 @@
+"""gunicorn settings for the shop (pip install gunicorn).
+
+    gunicorn -c gunicorn.conf.py app:app
+
+Several worker processes with a few threads each, so one register's
+checkout waiting on the SQLite write lock doesn't hold up the others. The
+app is imported once in the master (migrations run there), the catalog and
+templates are warmed, and the workers fork with all of it already loaded.
+
+Reloading without dropping a sale:
+    kill -HUP $(cat gunicorn.pid)   # new workers, same code (config changes)
+    bash RELOAD.sh                  # new master and workers on the pulled code
+UPDATE.sh stops and restarts the server instead: the pull may replace the DB.
+
+Knobs, from the environment: BOUTIQUE_BIND (0.0.0.0:5000), BOUTIQUE_WORKERS
+(2), BOUTIQUE_THREADS (4), BOUTIQUE_PRELOAD (1; 0 imports the app in each
+worker instead, and HUP then reloads the code too).
+"""
+import os
+
+import db
+import metrics
+
+bind = os.environ.get("BOUTIQUE_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("BOUTIQUE_WORKERS", "2"))
+worker_class = "gthread"
+threads = int(os.environ.get("BOUTIQUE_THREADS", "4"))
+preload_app = os.environ.get("BOUTIQUE_PRELOAD", "1") != "0"
+# A request stuck this long is a bug; the busy timeout on the DB is 5s
+timeout = 30
+graceful_timeout = 20
+keepalive = 5
+pidfile = "gunicorn.pid"
+# Common log format on stdout, which nohup.out keeps and bench.replay reads
+accesslog = "-"
+errorlog = "-"
+
+
+def _warm_up():
+    from app import warm_up
+
+    warm_up()
+    # SQLite connections must not cross a fork: drop the one warm_up used
+    db.close_pool()
+
+
+def when_ready(server):
+    if preload_app:
+        _warm_up()
+
+
+def pre_fork(server, worker):
+    # The master never serves requests, but make sure it holds no connection
+    db.close_pool()
+
+
+def post_fork(server, worker):
+    # Each worker reports its own numbers from its own start
+    metrics.reset()
+
+
+def worker_exit(server, worker):
+    # Close cleanly so a stopped server leaves no WAL behind (UPDATE.sh)
+    db.close_pool()
+
+
+def post_worker_init(worker):
+    if not preload_app:
+        _warm_up()
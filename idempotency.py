@@ -0,0 +1,64 @@
+"""Idempotency keys for write endpoints that clients retry.
+
+The register tags every purchase with a key (Idempotency-Key header). The
+first successful response is stored under that key in the same transaction
+as the write, so a retry after a lost response or a timeout gets the original
+answer back instead of a second order. Keys expire after TTL_SECONDS; that
+has to outlast the longest a sale can sit in the offline outbox.
+"""
+import hashlib
+import json
+import time
+
+TTL_SECONDS = 7 * 24 * 3600
+MAX_KEY_LENGTH = 128
+# Expired keys are swept at most this often per process
+SWEEP_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,
+    request_hash TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    response TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);
+"""
+
+_last_sweep = 0
+
+
+def request_key(req, data):
+    """The key sent with a request (header first, then JSON field), or None."""
+    key = req.headers.get("Idempotency-Key") or (data or {}).get("idempotency_key")
+    key = str(key).strip() if key else ""
+    return key[:MAX_KEY_LENGTH] or None
+
+
+def fingerprint(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()[:20]
+
+
+def lookup(conn, key):
+    """(request_hash, response dict, status) stored for key, or None."""
+    row = conn.execute(
+        "SELECT request_hash, response, status FROM idempotency_keys WHERE key = ? AND created_at >= ?",
+        (key, int(time.time()) - TTL_SECONDS),
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]), row[2]
+
+
+def remember(conn, key, request_hash, response, status=200):
+    """Store the response for key; call inside the write's transaction."""
+    global _last_sweep
+    now = int(time.time())
+    conn.execute(
+        "INSERT OR REPLACE INTO idempotency_keys (key, request_hash, created_at, status, response) VALUES (?, ?, ?, ?, ?)",
+        (key, request_hash, now, status, json.dumps(response, separators=(",", ":"))),
+    )
+    if now - _last_sweep >= SWEEP_INTERVAL:
+        _last_sweep = now
+        conn.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - TTL_SECONDS,))
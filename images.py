@@ -0,0 +1,253 @@
+"""Product image uploads: content-hashed originals plus resized variants.
+
+An upload is written once under the hash of its bytes, so the URL of a file
+never changes and can be cached forever. Grid- and detail-size JPEG and WebP
+variants are produced by the background worker; until they exist (or when
+Pillow isn't installed) pages simply fall back to the original.
+
+products.image is the only reference to a file: collect_garbage() deletes
+originals (and their variants) that no product points at any more. It only
+runs from 'flask gc-images', which also moves pre-hash uploads onto hashed
+names, and only against the database that owns the image folder:
+static/images belongs to Databases/boutique.db, and a copy or bench dataset
+references none of it.
+"""
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from contextlib import closing
+
+import catalog
+import db
+import tasks
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional; without it only originals are served
+    Image = None
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# As stored in products.image and used in URLs (always forward slashes)
+IMAGE_DIR = "static/images"
+# name -> pixel width; grid cards show ~100px tall, the detail size is for
+# larger screens and zoom
+VARIANT_WIDTHS = {"grid": 240, "detail": 800}
+VARIANT_FORMATS = {"webp": {"quality": 80, "method": 4}, "jpg": {"quality": 82, "optimize": True, "progressive": True}}
+ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+# Files named by content hash (and their variants) never change
+HASHED_NAME = re.compile(r"^[0-9a-f]{32}(-\d+)?\.\w+$")
+VARIANT_SUFFIX = re.compile("-(%s)$" % "|".join(str(w) for w in VARIANT_WIDTHS.values()))
+# How long a "no variants yet" answer is trusted before checking disk again
+MISSING_TTL = 30
+# Where IMAGE_DIR paths live on disk; BOUTIQUE_IMAGES moves them, as the
+# benchmarks do to keep their temp DBs away from the shop's photos
+IMAGE_ROOT = os.environ.get("BOUTIQUE_IMAGES") or os.path.join(BASE_DIR, *IMAGE_DIR.split("/"))
+# The database whose products own IMAGE_ROOT: the shop's, or BOUTIQUE_DB when
+# BOUTIQUE_IMAGES is set alongside it
+OWNER_DB = db.DB_PATH if os.environ.get("BOUTIQUE_IMAGES") else os.path.join(BASE_DIR, "Databases", "boutique.db")
+# Files younger than this are never collected: an upload is on disk before
+# the transaction that references it commits
+GC_GRACE = 3600
+
+_variants_seen = {}
+
+
+def _fs(path):
+    """Filesystem location of a 'static/images/...' DB path."""
+    if path == IMAGE_DIR or path.startswith(IMAGE_DIR + "/"):
+        return os.path.join(IMAGE_ROOT, *path[len(IMAGE_DIR):].split("/")[1:])
+    return os.path.join(BASE_DIR, *path.split("/"))
+
+
+def _write_atomic(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def save_upload(file_storage):
+    """Store an uploaded image and return its DB path ('static/images/<hash>.<ext>')."""
+    data = file_storage.read()
+    ext = os.path.splitext(file_storage.filename or "")[1].lower()
+    if ext not in ALLOWED_EXTENSIONS:
+        ext = ".jpg"
+    name = hashlib.sha256(data).hexdigest()[:32] + (".jpg" if ext == ".jpeg" else ext)
+    path = f"{IMAGE_DIR}/{name}"
+    os.makedirs(_fs(IMAGE_DIR), exist_ok=True)
+    # Same bytes, same name: a re-upload costs nothing. Touch the existing
+    # file so a concurrent GC pass sees it as fresh.
+    if os.path.exists(_fs(path)):
+        os.utime(_fs(path))
+    else:
+        _write_atomic(_fs(path), data)
+    tasks.submit(make_variants, path)
+    return path
+
+
+def variant_path(path, width, fmt):
+    stem = os.path.splitext(path)[0]
+    return f"{stem}-{width}.{fmt}"
+
+
+def make_variants(path):
+    """Write every missing resized variant of one original."""
+    if Image is None or not os.path.exists(_fs(path)):
+        return
+    wanted = [
+        (width, fmt) for width in VARIANT_WIDTHS.values() for fmt in VARIANT_FORMATS
+        if not os.path.exists(_fs(variant_path(path, width, fmt)))
+    ]
+    if not wanted:
+        return
+    with Image.open(_fs(path)) as original:
+        # Let the JPEG decoder downscale while reading; phone photos are huge
+        original.draft("RGB", (max(VARIANT_WIDTHS.values()) * 2,) * 2)
+        img = ImageOps.exif_transpose(original)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        for width, fmt in wanted:
+            resized = img.copy()
+            resized.thumbnail((width, width * 4))
+            if fmt == "jpg" and resized.mode != "RGB":
+                resized = resized.convert("RGB")
+            target = _fs(variant_path(path, width, fmt))
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), prefix=".variant-")
+            os.close(fd)
+            try:
+                resized.save(tmp, format="JPEG" if fmt == "jpg" else "WEBP", **VARIANT_FORMATS[fmt])
+                os.replace(tmp, target)
+            except Exception:
+                os.unlink(tmp)
+                raise
+    _variants_seen.pop(path, None)
+    # Cached pages and catalog JSON embed image URLs; let them pick up the variants
+    with closing(db.connect()) as conn:
+        catalog.bump(conn)
+        conn.commit()
+
+
+def variants(path):
+    """Variant URLs for an image path, or None while they don't exist yet.
+
+    Returns {"thumb": url, "srcset": "...", "webp_srcset": "..."} with
+    absolute URLs.
+    """
+    if not path:
+        return None
+    seen = _variants_seen.get(path)
+    if seen is not None and (seen[1] or time.monotonic() - seen[0] < MISSING_TTL):
+        return seen[1]
+    result = None
+    widths = sorted(VARIANT_WIDTHS.values())
+    if all(os.path.exists(_fs(variant_path(path, w, fmt))) for w in widths for fmt in VARIANT_FORMATS):
+        result = {
+            "thumb": "/" + variant_path(path, widths[0], "jpg"),
+            "srcset": ", ".join(f"/{variant_path(path, w, 'jpg')} {w}w" for w in widths),
+            "webp_srcset": ", ".join(f"/{variant_path(path, w, 'webp')} {w}w" for w in widths),
+        }
+    _variants_seen[path] = (time.monotonic(), result)
+    return result
+
+
+def is_immutable(filename):
+    return bool(HASHED_NAME.match(filename))
+
+
+def _stem(name):
+    """Name shared by an original and its variants: '<hash>-240.webp' -> '<hash>'."""
+    return VARIANT_SUFFIX.sub("", os.path.splitext(name)[0])
+
+
+def _is_original(name):
+    stem, ext = os.path.splitext(name)
+    return ext.lower() in ALLOWED_EXTENSIONS and not VARIANT_SUFFIX.search(stem) and not name.startswith(".")
+
+
+def adopt_legacy(conn):
+    """Move products still pointing at upload-named files onto hashed names.
+
+    Rows sharing a file, or files with identical bytes, end up on one name.
+    The old files are left for collect_garbage(). Returns the rows updated.
+    """
+    moved = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        legacy = [row[0] for row in conn.execute("SELECT DISTINCT image FROM products WHERE image LIKE ?", (IMAGE_DIR + "/%",))]
+        for path in legacy:
+            name = path[len(IMAGE_DIR) + 1:]
+            if is_immutable(name) or not os.path.exists(_fs(path)):
+                continue
+            with open(_fs(path), "rb") as fh:
+                data = fh.read()
+            ext = os.path.splitext(name)[1].lower()
+            if ext not in ALLOWED_EXTENSIONS or ext == ".jpeg":
+                ext = ".jpg"
+            target = f"{IMAGE_DIR}/{hashlib.sha256(data).hexdigest()[:32]}{ext}"
+            if not os.path.exists(_fs(target)):
+                _write_atomic(_fs(target), data)
+            moved += conn.execute("UPDATE products SET image = ? WHERE image = ?", (target, path)).rowcount
+            tasks.submit(make_variants, target)
+        if moved:
+            catalog.bump(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return moved
+
+
+def collect_garbage(conn=None, dry_run=False):
+    """Delete originals no product references, with their variants.
+
+    Returns the file names removed (or that would be, with dry_run). Raises
+    RuntimeError if conn is not the shop database.
+    """
+    if conn is None:
+        with closing(db.connect()) as conn:
+            return collect_garbage(conn, dry_run)
+    path = next(row[2] for row in conn.execute("PRAGMA database_list") if row[1] == "main")
+    if not path or os.path.realpath(path) != os.path.realpath(OWNER_DB):
+        raise RuntimeError(f"{path or ':memory:'} is not {OWNER_DB}; its products don't own {IMAGE_ROOT}")
+    folder = _fs(IMAGE_DIR)
+    if not os.path.isdir(folder):
+        return []
+    live = {
+        _stem(row[0][len(IMAGE_DIR) + 1:])
+        for row in conn.execute("SELECT DISTINCT image FROM products WHERE image LIKE ?", (IMAGE_DIR + "/%",))
+    }
+    cutoff = time.time() - GC_GRACE
+    removed = []
+    for entry in os.scandir(folder):
+        if not entry.is_file() or _stem(entry.name) in live:
+            continue
+        # Leftover temp files from an interrupted write go too, once stale
+        if entry.stat().st_mtime > cutoff:
+            continue
+        removed.append(entry.name)
+        if not dry_run:
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+            _variants_seen.pop(f"{IMAGE_DIR}/{entry.name}", None)
+    return sorted(removed)
+
+
+def backfill():
+    """Queue variants for every original in IMAGE_DIR that lacks them."""
+    queued = 0
+    for name in sorted(os.listdir(_fs(IMAGE_DIR))):
+        if not _is_original(name):
+            continue
+        tasks.submit(make_variants, f"{IMAGE_DIR}/{name}")
+        queued += 1
+    return queued
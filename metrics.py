@@ -0,0 +1,139 @@
+"""Per-endpoint request metrics in Prometheus text format.
+
+Every request records its latency, response size, and the number and total
+time of the SQL statements it ran (through db.query_hooks). /metrics exposes
+the lot for a scraper or a quick curl during the lunch rush. Numbers are per
+process: with several gunicorn workers each one reports its own share.
+"""
+import threading
+import time
+
+from flask import g, has_request_context, request
+
+import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+                break
+
+    def lines(self, name, labels):
+        out = []
+        cumulative = 0
+        for bound, hits in zip(self.buckets, self.counts):
+            cumulative += hits
+            out.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        out.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        out.append(f"{name}_sum{{{labels}}} {round(self.sum, 6)}")
+        out.append(f"{name}_count{{{labels}}} {self.count}")
+        return out
+
+
+_lock = threading.Lock()
+# (endpoint, method, status) -> count
+_requests = {}
+# endpoint -> Histogram
+_latency = {}
+_sizes = {}
+_statements = {}
+# endpoint -> [statements, seconds]
+_sql_totals = {}
+_started = time.time()
+
+
+def _on_query(conn, sql, parameters, seconds):
+    if has_request_context() and "metrics_start" in g:
+        g.sql_count += 1
+        g.sql_time += seconds
+
+
+def _before_request():
+    g.metrics_start = time.perf_counter()
+    g.sql_count = 0
+    g.sql_time = 0.0
+
+
+def _after_request(response):
+    if "metrics_start" not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    endpoint = request.endpoint or "unmatched"
+    # For a streamed body only a declared length counts (static files have
+    # one, exports don't): calculate_content_length() would buffer the stream
+    size = (response.content_length if response.is_streamed else response.calculate_content_length()) or 0
+    with _lock:
+        key = (endpoint, request.method, response.status_code)
+        _requests[key] = _requests.get(key, 0) + 1
+        _latency.setdefault(endpoint, Histogram(LATENCY_BUCKETS)).observe(elapsed)
+        _sizes.setdefault(endpoint, Histogram(SIZE_BUCKETS)).observe(size)
+        _statements.setdefault(endpoint, Histogram(STATEMENT_BUCKETS)).observe(g.sql_count)
+        totals = _sql_totals.setdefault(endpoint, [0, 0.0])
+        totals[0] += g.sql_count
+        totals[1] += g.sql_time
+    return response
+
+
+def render():
+    """Everything recorded so far, in Prometheus text exposition format."""
+    out = []
+    with _lock:
+        out += [
+            "# HELP boutique_http_requests_total Requests handled, by endpoint, method and status.",
+            "# TYPE boutique_http_requests_total counter",
+        ]
+        for (endpoint, method, status), count in sorted(_requests.items()):
+            out.append(f'boutique_http_requests_total{{endpoint="{endpoint}",method="{method}",status="{status}"}} {count}')
+        for name, kind, help_text, table in (
+            ("boutique_http_request_duration_seconds", "histogram", "Request latency.", _latency),
+            ("boutique_http_response_size_bytes", "histogram", "Response body size.", _sizes),
+            ("boutique_sql_statements_per_request", "histogram", "SQL statements run by one request.", _statements),
+        ):
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for endpoint, histogram in sorted(table.items()):
+                out += histogram.lines(name, f'endpoint="{endpoint}"')
+        out += [
+            "# HELP boutique_sql_statements_total SQL statements run while handling requests.",
+            "# TYPE boutique_sql_statements_total counter",
+        ]
+        out += [f'boutique_sql_statements_total{{endpoint="{e}"}} {t[0]}' for e, t in sorted(_sql_totals.items())]
+        out += [
+            "# HELP boutique_sql_seconds_total Time spent executing SQL while handling requests.",
+            "# TYPE boutique_sql_seconds_total counter",
+        ]
+        out += [f'boutique_sql_seconds_total{{endpoint="{e}"}} {t[1]:.6f}' for e, t in sorted(_sql_totals.items())]
+    out += [
+        "# HELP boutique_process_start_time_seconds Start time of this worker.",
+        "# TYPE boutique_process_start_time_seconds gauge",
+        f"boutique_process_start_time_seconds {_started:.0f}",
+    ]
+    return "\n".join(out) + "\n"
+
+
+def reset():
+    """Forget everything recorded so far (a freshly forked worker)."""
+    global _started
+    with _lock:
+        for table in (_requests, _latency, _sizes, _statements, _sql_totals):
+            table.clear()
+        _started = time.time()
+
+
+def init_app(app):
+    db.query_hooks.append(_on_query)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
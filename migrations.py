@@ -0,0 +1,210 @@
+"""Versioned schema for the shop DB, tracked in PRAGMA user_version.
+
+Each entry in MIGRATIONS moves the schema up one version and runs in its own
+write transaction together with the user_version bump, so a crash leaves the
+DB at the previous version and the next start simply tries again. Every step
+is written to be safe on the legacy databases that predate this runner
+(user_version 0 but tables already there), which is why they use IF NOT
+EXISTS and check for columns before adding them.
+
+    python -m migrations [path]     # bring a DB up to date by hand
+"""
+import sqlite3
+import sys
+
+import db
+import idempotency
+import ordering
+import reports
+
+
+BASE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS categories (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    position INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    price INTEGER NOT NULL DEFAULT 0,
+    image TEXT DEFAULT '',
+    position INTEGER DEFAULT 0,
+    category_id INTEGER,
+    inventory INTEGER NOT NULL DEFAULT 0,
+    FOREIGN KEY(category_id) REFERENCES categories(id)
+);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    total INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS order_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id INTEGER NOT NULL,
+    product_id INTEGER NOT NULL,
+    product_name TEXT NOT NULL,
+    category_name TEXT DEFAULT '',
+    unit_price INTEGER NOT NULL,
+    quantity INTEGER NOT NULL,
+    line_total INTEGER NOT NULL,
+    discount_percent INTEGER DEFAULT 0,
+    FOREIGN KEY(order_id) REFERENCES orders(id) ON DELETE CASCADE,
+    FOREIGN KEY(product_id) REFERENCES products(id) ON DELETE SET NULL
+);
+"""
+
+# Sales the register had already completed (offline outbox) that found less
+# stock than they sold; inventory was clamped at 0 and the gap is kept here
+STOCK_CONFLICTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stock_conflicts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    order_id INTEGER,
+    product_id INTEGER NOT NULL,
+    product_name TEXT NOT NULL DEFAULT '',
+    requested INTEGER NOT NULL,
+    available INTEGER,
+    created_at TEXT NOT NULL DEFAULT (datetime('now')),
+    seen_at TEXT
+);
+"""
+
+# What the hot queries filter and sort on: the category grid and
+# next-position lookups, order lines by order (chart, receipts, deletes),
+# the chart's date range, and check_duplicate_product_name
+INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_products_category_position ON products (category_id, position);
+CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items (order_id);
+CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at);
+CREATE INDEX IF NOT EXISTS idx_products_lower_name ON products (LOWER(name));
+"""
+
+
+def _script(conn, sql):
+    """Run several statements without executescript(), which would COMMIT."""
+    statement = ""
+    for line in sql.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            conn.execute(statement)
+            statement = ""
+
+
+def _columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def base_schema(conn):
+    _script(conn, BASE_SCHEMA)
+    # Columns added after the first shop DBs were created
+    if "position" not in _columns(conn, "categories"):
+        conn.execute("ALTER TABLE categories ADD COLUMN position INTEGER DEFAULT 0")
+    if "discount_percent" not in _columns(conn, "order_items"):
+        conn.execute("ALTER TABLE order_items ADD COLUMN discount_percent INTEGER DEFAULT 0")
+    conn.execute("UPDATE categories SET position = id WHERE position IS NULL OR position = 0")
+
+
+def meta_table(conn):
+    _script(conn, db.META_SCHEMA)
+
+
+def sales_rollups(conn):
+    fresh = not _has_table(conn, "sales_by_period")
+    _script(conn, reports.SCHEMA)
+    # Backfill from the order log the first time the tables appear
+    if fresh:
+        reports.rebuild_tables(conn)
+
+
+def stock_conflicts(conn):
+    _script(conn, STOCK_CONFLICTS_SCHEMA)
+
+
+def idempotency_keys(conn):
+    _script(conn, idempotency.SCHEMA)
+
+
+def indexes(conn):
+    _script(conn, INDEXES)
+    conn.execute("ANALYZE")
+
+
+def gapped_positions(conn):
+    # Spread positions out so a drag-and-drop move is a single-row write
+    conn.execute(
+        """
+        UPDATE products SET position = ranked.rn * ?
+        FROM (SELECT id, ROW_NUMBER() OVER (PARTITION BY category_id ORDER BY position, id) AS rn FROM products) AS ranked
+        WHERE products.id = ranked.id
+        """,
+        (ordering.POSITION_GAP,),
+    )
+    conn.execute(
+        """
+        UPDATE categories SET position = ranked.rn * ?
+        FROM (SELECT id, ROW_NUMBER() OVER (ORDER BY position, name) AS rn FROM categories) AS ranked
+        WHERE categories.id = ranked.id
+        """,
+        (ordering.POSITION_GAP,),
+    )
+
+
+def sales_by_discount(conn):
+    fresh = not _has_table(conn, "sales_by_discount")
+    _script(conn, reports.SCHEMA)
+    if fresh:
+        reports.rebuild_tables(conn, tables=("sales_by_discount",))
+
+
+# Append only: a step's position is its version number
+MIGRATIONS = [
+    base_schema,
+    meta_table,
+    sales_rollups,
+    stock_conflicts,
+    idempotency_keys,
+    indexes,
+    gapped_positions,
+    sales_by_discount,
+]
+LATEST = len(MIGRATIONS)
+
+
+def current_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """Apply every pending migration; returns the versions applied.
+
+    Safe to call from several processes at once: the version is re-read
+    under the write lock, so each step runs exactly once.
+    """
+    applied = []
+    while current_version(conn) < LATEST:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            version = current_version(conn)
+            if version >= LATEST:
+                conn.rollback()
+                break
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version + 1)
+    return applied
+
+
+if __name__ == "__main__":
+    conn = db.connect(sys.argv[1] if len(sys.argv) > 1 else None)
+    before = current_version(conn)
+    applied = migrate(conn)
+    conn.close()
+    print(f"user_version {before} -> {before + len(applied)}" if applied else f"user_version {before}, up to date")
@@ -0,0 +1,115 @@
+"""Sparse display positions for products and categories.
+
+Positions are spaced POSITION_GAP apart, so dragging one item between two
+others writes a single row: it takes the midpoint of its new neighbours.
+When a gap runs out (or legacy rows share a position) the list is respaced
+in the same transaction; once gaps get narrow a background respacing is
+queued so the next drags stay one-row writes.
+"""
+from contextlib import closing
+
+import catalog
+import db
+import tasks
+
+POSITION_GAP = 1024
+# Respace in the background once a move leaves a gap this narrow
+MIN_GAP = 8
+
+# table -> (column grouping the list or None, tie-breaker matching the snapshot order)
+LISTS = {
+    "products": ("category_id", "id"),
+    "categories": (None, "name"),
+}
+
+
+class StaleOrder(Exception):
+    """The client's neighbours are not neighbours in the DB any more."""
+
+
+def _scope(conn, table, item_id):
+    """(where clause, params) selecting the list item_id belongs to."""
+    column, _ = LISTS[table]
+    if column is None:
+        return "1", ()
+    row = conn.execute(f"SELECT {column} FROM {table} WHERE id = ?", (item_id,)).fetchone()
+    if row is None:
+        raise StaleOrder(f"{table} {item_id} not found")
+    return f"{column} IS ?", (row[0],)
+
+
+def respace(conn, table, where, params):
+    """Rewrite one list's positions as GAP, 2*GAP, ...; returns rows written."""
+    _, tiebreak = LISTS[table]
+    ordered = conn.execute(
+        f"SELECT id, position FROM {table} WHERE {where} ORDER BY position ASC, {tiebreak} ASC", params
+    ).fetchall()
+    changes = [
+        ((idx + 1) * POSITION_GAP, item_id)
+        for idx, (item_id, position) in enumerate(ordered)
+        if position != (idx + 1) * POSITION_GAP
+    ]
+    conn.executemany(f"UPDATE {table} SET position = ? WHERE id = ?", changes)
+    return len(changes)
+
+
+def next_position(conn, table, where="1", params=()):
+    """Position for a new item at the end of a list."""
+    last = conn.execute(f"SELECT MAX(position) FROM {table} WHERE {where}", params).fetchone()[0]
+    return (last or 0) + POSITION_GAP
+
+
+def move(conn, table, item_id, before_id=None, after_id=None):
+    """Place item_id between before_id (above it) and after_id (below it).
+
+    Either neighbour may be None at the ends of the list. Runs in the
+    caller's transaction and returns the item's new position.
+    """
+    if item_id in (before_id, after_id):
+        raise StaleOrder("an item can't be its own neighbour")
+    where, params = _scope(conn, table, item_id)
+
+    def neighbours():
+        found = dict(conn.execute(
+            f"SELECT id, position FROM {table} WHERE {where} AND id IN (?, ?)",
+            params + (before_id, after_id),
+        ).fetchall())
+        for neighbour in (before_id, after_id):
+            if neighbour is not None and neighbour not in found:
+                raise StaleOrder(f"{table} {neighbour} is not in the same list")
+        return found.get(before_id), found.get(after_id)
+
+    low, high = neighbours()
+    if low is not None and high is not None and high - low < 2:
+        # No integer left between them (or a legacy tie): respace the list,
+        # then look again
+        respace(conn, table, where, params)
+        low, high = neighbours()
+        if low >= high:
+            raise StaleOrder("neighbours are out of order")
+    if low is None and high is None:
+        position = next_position(conn, table, where, params)
+    elif low is None:
+        position = high - POSITION_GAP
+    elif high is None:
+        position = low + POSITION_GAP
+    else:
+        position = (low + high) // 2
+    conn.execute(f"UPDATE {table} SET position = ? WHERE id = ?", (position, item_id))
+    gaps = [abs(position - p) for p in (low, high) if p is not None]
+    if gaps and min(gaps) <= MIN_GAP:
+        tasks.submit(respace_later, table, where, params)
+    return position
+
+
+def respace_later(table, where, params):
+    """Background job: respace one list in its own transaction."""
+    with closing(db.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if respace(conn, table, where, params):
+                catalog.bump(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
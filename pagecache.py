@@ -0,0 +1,76 @@
+"""Rendered pages cached per version, precompressed and served with ETags.
+
+A page is rendered once per cache key (normally a db.version() tuple), then
+kept as identity, gzip and, when the optional brotli package is installed,
+brotli bodies. Each encoding gets its own strong ETag, so a client holding
+the current copy gets a bodyless 304.
+"""
+import gzip
+import hashlib
+import threading
+
+from flask import make_response, request
+
+try:
+    import brotli
+except ImportError:  # optional; gzip alone is fine
+    brotli = None
+
+
+class Page:
+    def __init__(self, key, body, mimetype):
+        self.key = key
+        self.mimetype = mimetype
+        raw = body.encode("utf-8") if isinstance(body, str) else body
+        tag = hashlib.sha1(raw).hexdigest()[:20]
+        # encoding -> (etag, bytes); identity first so it is the fallback
+        self.variants = {"identity": (tag, raw)}
+        self.variants["gzip"] = (tag + "-gz", gzip.compress(raw, compresslevel=9, mtime=0))
+        if brotli is not None:
+            self.variants["br"] = (tag + "-br", brotli.compress(raw, quality=11))
+
+
+# Oldest pages are dropped past this many (receipts add one per order viewed)
+MAX_PAGES = 256
+
+_lock = threading.Lock()
+_pages = {}
+
+
+def _pick_encoding(page):
+    accepted = request.accept_encodings
+    for encoding in ("br", "gzip"):
+        if encoding in page.variants and accepted.quality(encoding) > 0:
+            return encoding
+    return "identity"
+
+
+def cached(name, key, render, mimetype="text/html", max_age=0):
+    """Respond with page `name` for cache `key`, calling render() only on a miss."""
+    page = _pages.get(name)
+    if page is None or page.key != key:
+        page = Page(key, render(), mimetype)
+        with _lock:
+            _pages.pop(name, None)
+            _pages[name] = page
+            while len(_pages) > MAX_PAGES:
+                _pages.pop(next(iter(_pages)))
+    encoding = _pick_encoding(page)
+    etag, body = page.variants[encoding]
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(body)
+        response.mimetype = mimetype
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = f"private, max-age={max_age}, must-revalidate" if max_age else "no-cache"
+    response.vary.add("Accept-Encoding")
+    response.vary.add("Cookie")
+    return response
+
+
+def invalidate(name):
+    with _lock:
+        _pages.pop(name, None)
@@ -0,0 +1,266 @@
+"""Bulk product and stock import from a CSV or XLSX sheet.
+
+One line per product: name, price, category, and the stock received (a delta
+added to the current inventory; negative to correct a count). Empty price or
+category leaves an existing product's value alone. Names are matched
+case-insensitively after normalising, so "coca cola" updates "Coca Cola".
+
+An import is two steps. plan() reads the sheet against the DB and returns
+an Import describing what would change, which the inventory page shows as a
+dry run. apply() then plans again under the write lock and writes every
+product in one executemany upsert, plus one for any new categories, in a
+single transaction. A sheet of thousands of lines is a handful of
+statements either way.
+
+XLSX needs the optional openpyxl package; CSV always works.
+"""
+import csv
+import io
+import json
+import os
+import re
+import tempfile
+import time
+import unicodedata
+import uuid
+
+import catalog
+import ordering
+
+try:
+    import openpyxl
+except ImportError:  # optional; CSV alone is fine
+    openpyxl = None
+
+# Recognised headers (lowercased, accents stripped) -> field
+HEADERS = {
+    "name": "name", "nombre": "name", "producto": "name",
+    "price": "price", "precio": "price",
+    "category": "category", "categoria": "category",
+    "stock": "stock", "cantidad": "stock", "qty": "stock", "recibido": "stock", "inventario": "stock",
+}
+# Keeps IN (...) lists well under SQLite's variable limit
+CHUNK = 500
+# Sheets waiting for confirmation after their dry run; shared by all workers
+PENDING_DIR = os.path.join(tempfile.gettempdir(), "boutique-imports")
+PENDING_TTL = 24 * 3600
+
+
+class SheetError(Exception):
+    """The sheet itself can't be read (format, missing name column)."""
+
+
+class Import:
+    def __init__(self):
+        # [(line, name, price, category, stock)]
+        self.new_products = []
+        # [(line, id, name, (old price, new price), (old category, new category), (old stock, new stock))]
+        self.updates = []
+        self.unchanged = 0
+        self.new_categories = []
+        # [(line, message)]
+        self.errors = []
+        # Rows ready for apply(): [(name, price, category name, stock delta)]
+        self.rows = []
+
+    @property
+    def changes(self):
+        return len(self.new_products) + len(self.updates)
+
+
+def _fold(text):
+    return unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii").strip().lower()
+
+
+def read_sheet(filename, data):
+    """[(line number, {field: text})] from an uploaded .csv or .xlsx file's bytes."""
+    if filename.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise SheetError("Para importar XLSX hace falta openpyxl (pip install openpyxl); usa CSV.")
+        sheet = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True).active
+        table = [["" if cell is None else str(cell) for cell in row] for row in sheet.iter_rows(values_only=True)]
+    else:
+        text = data.decode("utf-8-sig", errors="replace")
+        # Spreadsheets in Spanish locales export with ';'
+        delimiter = ";" if text.split("\n", 1)[0].count(";") > text.split("\n", 1)[0].count(",") else ","
+        table = list(csv.reader(io.StringIO(text), delimiter=delimiter))
+    if not table:
+        raise SheetError("El archivo está vacío.")
+    fields = [HEADERS.get(_fold(header)) for header in table[0]]
+    if "name" not in fields:
+        raise SheetError("Falta la columna de nombre (name/nombre/producto).")
+    rows = []
+    for line, values in enumerate(table[1:], start=2):
+        record = {field: value.strip() for field, value in zip(fields, values) if field}
+        if any(record.values()):
+            rows.append((line, record))
+    return rows
+
+
+def save_pending(sheet):
+    """Keep a read sheet until the dry run is confirmed; returns its token."""
+    os.makedirs(PENDING_DIR, exist_ok=True)
+    cutoff = time.time() - PENDING_TTL
+    for entry in os.scandir(PENDING_DIR):
+        if entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
+    token = uuid.uuid4().hex
+    with open(os.path.join(PENDING_DIR, f"{token}.json"), "w", encoding="utf-8") as f:
+        json.dump(sheet, f)
+    return token
+
+
+def claim_pending(token):
+    """Take the sheet saved under token, so it can be applied only once.
+
+    The file is renamed away before it is read: of two submits of the same
+    token (a double click, a browser retry) exactly one gets the sheet.
+    Returns None if it expired or was already claimed.
+    """
+    if not re.fullmatch(r"[0-9a-f]{32}", token or ""):
+        return None
+    path = os.path.join(PENDING_DIR, f"{token}.json")
+    claimed = f"{path}.{uuid.uuid4().hex}"
+    try:
+        os.rename(path, claimed)
+    except OSError:
+        return None
+    try:
+        with open(claimed, encoding="utf-8") as f:
+            return [(line, record) for line, record in json.load(f)]
+    finally:
+        os.remove(claimed)
+
+
+def _number(text, what):
+    cleaned = re.sub(r"[\s$,]", "", text)
+    if cleaned.endswith(".0"):
+        # Spreadsheet cells come back as floats
+        cleaned = cleaned[:-2]
+    if not re.fullmatch(r"-?\d+", cleaned):
+        raise ValueError(f"{what} no válido: '{text}'")
+    return int(cleaned)
+
+
+def plan(conn, sheet, normalize):
+    """Work out what importing sheet (from read_sheet) would do; writes nothing.
+
+    normalize is applied to product names (the app's smart_capitalize).
+    """
+    result = Import()
+    # Merge repeated lines for one product: stock adds up, the last price and
+    # category win
+    merged = {}
+    for line, record in sheet:
+        name = normalize(record.get("name", ""))
+        if not name:
+            result.errors.append((line, "Falta el nombre"))
+            continue
+        try:
+            price = _number(record["price"], "Precio") if record.get("price") else None
+            stock = _number(record["stock"], "Cantidad") if record.get("stock") else 0
+        except ValueError as e:
+            result.errors.append((line, str(e)))
+            continue
+        key = catalog.name_key(name)
+        if key in merged:
+            _, _, old_price, old_category, old_stock = merged[key]
+            price = old_price if price is None else price
+            category = record.get("category") or old_category
+            stock += old_stock
+        else:
+            category = record.get("category") or None
+        merged[key] = (line, name, price, category, stock)
+
+    existing = {}
+    keys = list(merged)
+    for start in range(0, len(keys), CHUNK):
+        chunk = keys[start:start + CHUNK]
+        for row in conn.execute(
+            f"""
+            SELECT p.id, p.name, p.price, c.name, p.inventory FROM products p LEFT JOIN categories c ON c.id = p.category_id
+            WHERE LOWER(p.name) IN ({','.join('?' * len(chunk))})
+            """,
+            chunk,
+        ):
+            existing[catalog.name_key(row[1])] = row
+    categories = {name.lower(): name for (name,) in conn.execute("SELECT name FROM categories")}
+
+    new_categories = {}
+    for key, (line, name, price, category, stock) in merged.items():
+        if category:
+            category = categories.get(category.lower()) or new_categories.setdefault(category.lower(), category)
+        row = existing.get(key)
+        if row is None:
+            if not category:
+                result.errors.append((line, f"'{name}' es nuevo y necesita una categoría"))
+                continue
+            if stock < 0:
+                result.errors.append((line, f"'{name}' es nuevo y no puede empezar con stock negativo"))
+                continue
+            result.new_products.append((line, name, price or 0, category, stock))
+            result.rows.append((name, price or 0, category, stock))
+            continue
+        product_id, current_name, current_price, current_category, inventory = row
+        price = current_price if price is None else price
+        category = category or current_category
+        if price == current_price and category == current_category and stock == 0:
+            result.unchanged += 1
+            continue
+        result.updates.append((
+            line, product_id, current_name, (current_price, price), (current_category, category),
+            (inventory, max(inventory + stock, 0)),
+        ))
+        result.rows.append((current_name, price, category, stock))
+    result.new_categories = sorted(new_categories.values())
+    return result
+
+
+def apply(conn, sheet, normalize):
+    """Plan sheet again under the write lock and write it in one transaction.
+
+    Returns the Import that was applied. Nothing is written if the plan has
+    errors.
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = plan(conn, sheet, normalize)
+        if result.errors or not result.changes:
+            conn.rollback()
+            return result
+        position = ordering.next_position(conn, "categories")
+        conn.executemany(
+            "INSERT INTO categories (name, position) VALUES (?, ?)",
+            [(name, position + idx * ordering.POSITION_GAP) for idx, name in enumerate(result.new_categories)],
+        )
+        category_ids = {name: cid for cid, name in conn.execute("SELECT id, name FROM categories")}
+        # New and moved products go to the end of their category
+        ends = dict(conn.execute("SELECT category_id, MAX(position) FROM products GROUP BY category_id"))
+        rows = []
+        for name, price, category, stock in result.rows:
+            category_id = category_ids.get(category)
+            ends[category_id] = (ends.get(category_id) or 0) + ordering.POSITION_GAP
+            rows.append((name, price, ends[category_id], category_id, stock))
+        # Existing names were resolved to their stored spelling by plan(), so
+        # the UNIQUE(name) conflict is exactly "this product already exists"
+        conn.executemany(
+            """
+            INSERT INTO products (name, price, image, position, category_id, inventory) VALUES (?, ?, '', ?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                price = excluded.price,
+                position = CASE WHEN products.category_id IS excluded.category_id THEN products.position ELSE excluded.position END,
+                category_id = excluded.category_id,
+                inventory = MAX(products.inventory + excluded.inventory, 0)
+            """,
+            rows,
+        )
+        # A sheet of stock counts alone leaves the catalog snapshot alone
+        if result.new_products or any(price[0] != price[1] or category[0] != category[1] for _, _, _, price, category, _ in result.updates):
+            catalog.bump(conn)
+        if any(stock for *_, stock in result.rows):
+            catalog.bump_stock(conn)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return result
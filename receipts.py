@@ -0,0 +1,89 @@
+"""Receipts rendered from the stored order, not from what the client sent.
+
+An order never changes after checkout; it can only be deleted. Rendered
+receipts are therefore cached under a version that only delete_order bumps.
+
+Receipt URLs carry a signed token for the order rather than its id: ids are
+sequential, so anyone on the shop's network could otherwise walk through
+every sale by counting.
+"""
+import unicodedata
+
+from itsdangerous import BadSignature, URLSafeSerializer
+
+import db
+
+VERSION_KEY = "receipts_version"
+# Characters per line on a 58mm thermal printer
+TICKET_WIDTH = 32
+
+
+class Receipt:
+    def __init__(self, order_id, created_at, total, lines):
+        self.order_id = order_id
+        self.created_at = created_at
+        self.total = total
+        # [{"name", "category", "qty", "unit_price", "discount_percent", "subtotal"}]
+        self.lines = lines
+
+
+def token(order_id, secret):
+    """URL-safe receipt token for order_id, signed with the app's secret key."""
+    return URLSafeSerializer(secret, salt="receipt").dumps(order_id)
+
+
+def order_id(token, secret):
+    """The order id signed into token, or None if it isn't a valid receipt token."""
+    try:
+        value = URLSafeSerializer(secret, salt="receipt").loads(token)
+    except BadSignature:
+        return None
+    return value if isinstance(value, int) else None
+
+
+def bump(conn):
+    """Mark receipts as changed (an order was deleted); call inside the transaction."""
+    db.bump_version(conn, VERSION_KEY)
+
+
+def load(conn, order_id):
+    """The Receipt for order_id, or None if there is no such order."""
+    order = conn.execute("SELECT id, created_at, total FROM orders WHERE id = ?", (order_id,)).fetchone()
+    if order is None:
+        return None
+    rows = conn.execute(
+        """
+        SELECT product_name, COALESCE(NULLIF(category_name, ''), 'Unknown'), quantity, unit_price,
+               COALESCE(discount_percent, 0), line_total
+        FROM order_items WHERE order_id = ? ORDER BY id
+        """,
+        (order_id,),
+    ).fetchall()
+    lines = [
+        {"name": name, "category": category, "qty": qty, "unit_price": unit_price, "discount_percent": discount, "subtotal": subtotal}
+        for name, category, qty, unit_price, discount, subtotal in rows
+    ]
+    return Receipt(order[0], order[1], order[2], lines)
+
+
+def _ascii(text):
+    # Thermal printers rarely have the accented glyphs; fold them away
+    return unicodedata.normalize("NFKD", str(text)).encode("ascii", "ignore").decode("ascii")
+
+
+def _row(left, right, width):
+    left = left[: width - len(right) - 1]
+    return left + " " * (width - len(left) - len(right)) + right
+
+
+def as_text(receipt, shop="Good Food", width=TICKET_WIDTH):
+    """Plain-text ticket, width characters per line."""
+    out = [shop.center(width), f"Pedido #{receipt.order_id}".center(width), receipt.created_at.center(width), "-" * width]
+    for line in receipt.lines:
+        out.append(_ascii(line["name"])[:width])
+        detail = f"  {line['qty']} x ${line['unit_price']}"
+        if line["discount_percent"]:
+            detail += f" -{line['discount_percent']}%"
+        out.append(_row(detail, f"${line['subtotal']}", width))
+    out += ["-" * width, _row("TOTAL", f"${receipt.total}", width), "", "Gracias por tu compra!".center(width), ""]
+    return "\n".join(text.rstrip() for text in out)
@@ -0,0 +1,208 @@
+"""Sales rollups kept in step with orders.
+
+Every order is folded into per-day and per-hour buckets (UTC, the same clock
+as orders.created_at) by period, by product, by category and by discount
+level. api_purchase adds an order inside its transaction and delete_order
+subtracts it, so reporting reads a few hundred rollup rows instead of the raw
+order log. Each change also bumps meta(sales_version), which is what cached
+reports are keyed on.
+"""
+import db
+
+VERSION_KEY = "sales_version"
+
+GRAINS = {
+    "day": "substr(o.created_at, 1, 10)",
+    "hour": "substr(o.created_at, 1, 13) || ':00'",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sales_by_period (
+    grain TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    orders INTEGER NOT NULL DEFAULT 0,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    gross INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (grain, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sales_by_product (
+    grain TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    product_id INTEGER NOT NULL,
+    product_name TEXT NOT NULL DEFAULT '',
+    category_name TEXT NOT NULL DEFAULT '',
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    gross INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (grain, bucket, product_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sales_by_category (
+    grain TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    category_name TEXT NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    gross INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (grain, bucket, category_name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sales_by_discount (
+    grain TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    discount_percent INTEGER NOT NULL,
+    lines INTEGER NOT NULL DEFAULT 0,
+    quantity INTEGER NOT NULL DEFAULT 0,
+    revenue INTEGER NOT NULL DEFAULT 0,
+    gross INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (grain, bucket, discount_percent)
+) WITHOUT ROWID;
+"""
+
+# table -> (key columns, INSERT ... SELECT template). "gross" is the line total
+# before discount; revenue is what was actually charged.
+ROLLUPS = {
+    "sales_by_period": (
+        ("grain", "bucket"),
+        """
+        INSERT INTO {table} (grain, bucket, orders, quantity, revenue, gross)
+        SELECT '{grain}', {bucket}, :sign * COUNT(DISTINCT o.id), :sign * SUM(oi.quantity),
+               :sign * SUM(oi.line_total), :sign * SUM(oi.unit_price * oi.quantity)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE {where}
+        GROUP BY 2
+        {upsert}
+        """,
+    ),
+    "sales_by_product": (
+        ("grain", "bucket", "product_id"),
+        """
+        INSERT INTO {table} (grain, bucket, product_id, product_name, category_name, quantity, revenue, gross)
+        SELECT '{grain}', {bucket}, oi.product_id, MAX(oi.product_name),
+               MAX(COALESCE(NULLIF(oi.category_name, ''), 'Unknown')), :sign * SUM(oi.quantity),
+               :sign * SUM(oi.line_total), :sign * SUM(oi.unit_price * oi.quantity)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE {where}
+        GROUP BY 2, 3
+        {upsert}
+        """,
+    ),
+    "sales_by_category": (
+        ("grain", "bucket", "category_name"),
+        """
+        INSERT INTO {table} (grain, bucket, category_name, quantity, revenue, gross)
+        SELECT '{grain}', {bucket}, COALESCE(NULLIF(oi.category_name, ''), 'Unknown'), :sign * SUM(oi.quantity),
+               :sign * SUM(oi.line_total), :sign * SUM(oi.unit_price * oi.quantity)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE {where}
+        GROUP BY 2, 3
+        {upsert}
+        """,
+    ),
+    "sales_by_discount": (
+        ("grain", "bucket", "discount_percent"),
+        """
+        INSERT INTO {table} (grain, bucket, discount_percent, lines, quantity, revenue, gross)
+        SELECT '{grain}', {bucket}, COALESCE(oi.discount_percent, 0), :sign * COUNT(*), :sign * SUM(oi.quantity),
+               :sign * SUM(oi.line_total), :sign * SUM(oi.unit_price * oi.quantity)
+        FROM orders o JOIN order_items oi ON oi.order_id = o.id
+        WHERE {where}
+        GROUP BY 2, 3
+        {upsert}
+        """,
+    ),
+}
+
+MEASURES = {
+    "sales_by_period": ("orders", "quantity", "revenue", "gross"),
+    "sales_by_product": ("quantity", "revenue", "gross"),
+    "sales_by_category": ("quantity", "revenue", "gross"),
+    "sales_by_discount": ("lines", "quantity", "revenue", "gross"),
+}
+
+
+def _upsert_clause(table):
+    keys, _ = ROLLUPS[table]
+    sets = [f"{col} = {col} + excluded.{col}" for col in MEASURES[table]]
+    if table == "sales_by_product":
+        sets += ["product_name = excluded.product_name", "category_name = excluded.category_name"]
+    return f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {', '.join(sets)}"
+
+
+def apply_order(conn, order_id, sign=1):
+    """Add (sign=1) or remove (sign=-1) one order's lines from every rollup.
+
+    Runs on the caller's connection and does not commit, so it lands in the
+    same transaction as the order write itself.
+    """
+    params = {"sign": sign, "order_id": order_id}
+    for table, (_, template) in ROLLUPS.items():
+        for grain, bucket in GRAINS.items():
+            conn.execute(
+                template.format(table=table, grain=grain, bucket=bucket, where="o.id = :order_id", upsert=_upsert_clause(table)),
+                params,
+            )
+            if sign < 0:
+                # Drop rows the removal emptied so a rebuild compares equal
+                zero = " AND ".join(f"{col} = 0" for col in MEASURES[table])
+                conn.execute(
+                    f"DELETE FROM {table} WHERE grain = '{grain}' AND bucket = (SELECT {bucket} FROM orders o WHERE o.id = :order_id) AND {zero}",
+                    params,
+                )
+    db.bump_version(conn, VERSION_KEY)
+
+
+def rebuild_tables(conn, check_only=False, tables=None):
+    """Regenerate the rollups (all, or just `tables`) from orders/order_items
+    in the caller's transaction.
+
+    Returns {table: number of rows that differed from the live table}. With
+    check_only the live tables are left untouched.
+    """
+    diffs = {}
+    for table in tables or ROLLUPS:
+        keys, template = ROLLUPS[table]
+        scratch = f"temp.rebuild_{table}"
+        conn.execute(f"DROP TABLE IF EXISTS {scratch}")
+        conn.execute(f"CREATE TEMP TABLE rebuild_{table} AS SELECT * FROM {table} WHERE 0")
+        for grain, bucket in GRAINS.items():
+            conn.execute(
+                template.format(table=scratch, grain=grain, bucket=bucket, where="1", upsert=""),
+                {"sign": 1},
+            )
+        cols = ", ".join(keys + MEASURES[table])
+        diffs[table] = conn.execute(
+            f"""
+            SELECT COUNT(*) FROM (
+                SELECT * FROM (SELECT {cols} FROM {table} EXCEPT SELECT {cols} FROM {scratch})
+                UNION ALL
+                SELECT * FROM (SELECT {cols} FROM {scratch} EXCEPT SELECT {cols} FROM {table})
+            )
+            """
+        ).fetchone()[0]
+        if not check_only:
+            conn.execute(f"DELETE FROM {table}")
+            conn.execute(f"INSERT INTO {table} SELECT * FROM {scratch}")
+        conn.execute(f"DROP TABLE {scratch}")
+    if not check_only and any(diffs.values()):
+        db.bump_version(conn, VERSION_KEY)
+    return diffs
+
+
+def rebuild(conn, check_only=False):
+    """rebuild_tables() in a write transaction of its own."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        diffs = rebuild_tables(conn, check_only)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return diffs
+
+
+def period_totals(conn, start_day, end_day):
+    """(orders, revenue) for whole days start_day..end_day, both 'YYYY-MM-DD'."""
+    return conn.execute(
+        "SELECT COALESCE(SUM(orders), 0), COALESCE(SUM(revenue), 0) FROM sales_by_period WHERE grain = 'day' AND bucket BETWEEN ? AND ?",
+        (start_day, end_day),
+    ).fetchone()
@@ -0,0 +1,147 @@
+"""Slow SQL statements, with the route that ran them and their query plan.
+
+Hooks into db.query_hooks, so it sees every statement on the shop's
+connections with its execute() time. Statements over SLOW_QUERY_MS are
+logged together with their EXPLAIN QUERY PLAN and aggregated per statement
+text for /debug/queries, where a "SCAN products" next to a growing total
+points straight at the missing index. Like metrics, the figures are per
+process.
+
+The time is what execute() took: for a SELECT that is the work up to the
+first row, which includes any full scan or sort, but not the fetching of
+the remaining rows.
+
+A slow BEGIN IMMEDIATE or COMMIT is time spent waiting for another writer's
+lock (or the disk), not a statement to tune, so transaction control is
+counted per route as lock waits and kept out of the slow statements.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+from flask import has_request_context, request
+
+import db
+
+SLOW_QUERY_MS = float(os.environ.get("BOUTIQUE_SLOW_QUERY_MS", "50"))
+# Individual slow statements kept for the "recent" list
+RECENT = 100
+# Statements EXPLAIN QUERY PLAN can describe
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "END", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+log = logging.getLogger(__name__)
+
+
+class Offender:
+    """Every slow run of one statement text."""
+
+    def __init__(self, sql):
+        self.sql = sql
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.routes = {}
+        self.plan = []
+        self.last_seen = None
+
+    @property
+    def avg_ms(self):
+        return self.total_ms / self.count if self.count else 0.0
+
+    @property
+    def scans(self):
+        """Plan steps that read a whole table instead of using an index."""
+        return [step for step in self.plan if step.startswith("SCAN") and " USING " not in step]
+
+
+_lock = threading.Lock()
+# normalised SQL -> Offender
+_offenders = {}
+_recent = deque(maxlen=RECENT)
+# route -> [count, total ms, max ms]
+_lock_waits = {}
+
+
+def normalise(sql):
+    return re.sub(r"\s+", " ", sql).strip()
+
+
+def _route():
+    if not has_request_context():
+        return "(background)"
+    return f"{request.method} {request.endpoint or request.path}"
+
+
+def explain(conn, sql, parameters):
+    """The plan as a list of step descriptions; [] if it can't be explained."""
+    if not sql.lstrip().upper().startswith(EXPLAINABLE) or parameters is None:
+        return []
+    try:
+        # Straight to sqlite3 so the EXPLAIN itself isn't timed and reported
+        rows = sqlite3.Connection.execute(conn, "EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    except sqlite3.Error:
+        return []
+    return [row[3] for row in rows]
+
+
+def _on_query(conn, sql, parameters, seconds):
+    elapsed_ms = seconds * 1000
+    if elapsed_ms < SLOW_QUERY_MS:
+        return
+    text = normalise(sql)
+    route = _route()
+    if text.upper().startswith(TRANSACTION_CONTROL):
+        log.info("lock wait %.1f ms [%s] %s", elapsed_ms, route, text)
+        with _lock:
+            wait = _lock_waits.setdefault(route, [0, 0.0, 0.0])
+            wait[0] += 1
+            wait[1] += elapsed_ms
+            wait[2] = max(wait[2], elapsed_ms)
+        return
+    plan = explain(conn, sql, parameters)
+    log.warning("slow query %.1f ms [%s] %s | plan: %s", elapsed_ms, route, text, "; ".join(plan) or "-")
+    now = time.time()
+    with _lock:
+        offender = _offenders.get(text)
+        if offender is None:
+            offender = _offenders[text] = Offender(text)
+        offender.count += 1
+        offender.total_ms += elapsed_ms
+        offender.max_ms = max(offender.max_ms, elapsed_ms)
+        offender.routes[route] = offender.routes.get(route, 0) + 1
+        # Keep the latest plan: it changes as the data grows or after ANALYZE
+        if plan:
+            offender.plan = plan
+        offender.last_seen = now
+        _recent.appendleft((now, route, elapsed_ms, text))
+
+
+def top(limit=25):
+    """Worst statements first, by total time spent over the threshold."""
+    with _lock:
+        ranked = sorted(_offenders.values(), key=lambda o: o.total_ms, reverse=True)
+        recent = list(_recent)
+    return ranked[:limit], recent
+
+
+def lock_waits():
+    """[(route, count, total ms, max ms)], longest total first."""
+    with _lock:
+        waits = [(route, *wait) for route, wait in _lock_waits.items()]
+    return sorted(waits, key=lambda w: w[2], reverse=True)
+
+
+def reset():
+    with _lock:
+        _offenders.clear()
+        _recent.clear()
+        _lock_waits.clear()
+
+
+def init_app(app):
+    db.query_hooks.append(_on_query)
@@ -0,0 +1,128 @@
+// Purchase outbox: checkouts are stored in IndexedDB first and sent to
+// /api/purchase in the background, so a sale never waits on (or is lost to)
+// the network. Loaded by the register page and by the service worker.
+(function (scope) {
+  const DB_NAME = 'boutique';
+  const STORE = 'outbox';
+  // Retries are safe (each sale carries its key as Idempotency-Key), so give
+  // up on a slow request early and try again rather than wait it out
+  const SEND_TIMEOUT_MS = 4000;
+  const RETRY_DELAYS_MS = [500, 1500];
+
+  let dbPromise = null;
+
+  function openDb() {
+    if (!dbPromise) {
+      dbPromise = new Promise((resolve, reject) => {
+        const req = indexedDB.open(DB_NAME, 1);
+        req.onupgradeneeded = () => req.result.createObjectStore(STORE, { keyPath: 'key' });
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => { dbPromise = null; reject(req.error); };
+      });
+    }
+    return dbPromise;
+  }
+
+  function run(mode, fn) {
+    return openDb().then(db => new Promise((resolve, reject) => {
+      const tx = db.transaction(STORE, mode);
+      const result = fn(tx.objectStore(STORE));
+      tx.oncomplete = () => resolve(result && 'result' in result ? result.result : undefined);
+      tx.onerror = () => reject(tx.error);
+      tx.onabort = () => reject(tx.error);
+    }));
+  }
+
+  function newKey() {
+    // Time-ordered so the outbox drains in sale order
+    const rand = (scope.crypto && crypto.randomUUID) ? crypto.randomUUID() : Math.random().toString(36).slice(2);
+    return `${Date.now().toString(36).padStart(10, '0')}-${rand}`;
+  }
+
+  // Store one sale; resolves with its key once it is safely on disk
+  function enqueue(items) {
+    const entry = { key: newKey(), items, sold_at: new Date().toISOString() };
+    return run('readwrite', store => store.add(entry)).then(() => entry.key);
+  }
+
+  function count() {
+    return run('readonly', store => store.count());
+  }
+
+  // Sales the server answered with something other than a receipt; they stay
+  // queued (and are retried) until someone looks into it
+  function failed() {
+    return run('readonly', store => store.getAll()).then(entries => entries.filter(e => e.failed));
+  }
+
+  // live: the sale just rung up, sent while the customer is still at the
+  // counter, so an oversell comes back as a 409 instead of being reconciled
+  function sendOnce(entry, live) {
+    const controller = new AbortController();
+    const timer = setTimeout(() => controller.abort(), SEND_TIMEOUT_MS);
+    return fetch('/api/purchase', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json', 'Idempotency-Key': entry.key },
+      body: JSON.stringify({ items: entry.items, sold_at: entry.sold_at, reconcile: !live }),
+      credentials: 'same-origin',
+      signal: controller.signal,
+    }).finally(() => clearTimeout(timer));
+  }
+
+  async function send(entry, live) {
+    for (let attempt = 0; ; attempt++) {
+      try {
+        const res = await sendOnce(entry, live);
+        if (res.status < 500 || attempt >= RETRY_DELAYS_MS.length) return res;
+      } catch (e) {
+        if (attempt >= RETRY_DELAYS_MS.length) throw e;
+      }
+      await new Promise(resolve => setTimeout(resolve, RETRY_DELAYS_MS[attempt]));
+    }
+  }
+
+  // Send queued sales oldest first; stops at the first network/server error
+  // and leaves the rest for the next attempt. Resolves with
+  // { outbox key: { receipt } or { redirect } } for the sales the server
+  // settled. A sale leaves the outbox only once the server has stored it
+  // (or, for the live sale, refused it as an oversell the cashier now sees):
+  // anything else, say a captive portal's login page, marks it failed.
+  function drain(liveKey) {
+    return run('readonly', store => store.getAll()).then(async entries => {
+      const settled = {};
+      for (const entry of entries) {
+        const live = entry.key === liveKey;
+        let res;
+        try {
+          res = await send(entry, live);
+        } catch (e) {
+          break; // offline or timed out
+        }
+        if (res.status >= 500) break;
+        const body = await res.json().catch(() => ({}));
+        if (res.ok && body.status === 'ok') {
+          settled[entry.key] = { receipt: body.receipt };
+        } else if (live && res.status === 409 && body.redirect) {
+          settled[entry.key] = { redirect: body.redirect };
+        } else {
+          console.warn('Venta rechazada por el servidor', entry, res.status);
+          const failure = { status: res.status, at: new Date().toISOString() };
+          await run('readwrite', store => store.put(Object.assign({}, entry, { failed: failure })));
+          continue;
+        }
+        await run('readwrite', store => store.delete(entry.key));
+      }
+      return settled;
+    });
+  }
+
+  // Page and service worker may both try to flush; only one at a time
+  function flush(liveKey) {
+    if (scope.navigator && navigator.locks) {
+      return navigator.locks.request('boutique-outbox', { ifAvailable: true }, lock => (lock ? drain(liveKey) : {}));
+    }
+    return drain(liveKey);
+  }
+
+  scope.Outbox = { enqueue, count, failed, flush };
+})(self);
@@ -0,0 +1,96 @@
+// Service worker for the register: keeps the app shell, catalog JSON and
+// product images available offline and drains the purchase outbox.
+importScripts('/static/js/outbox.js');
+
+const VERSION = 'v3';
+const SHELL_CACHE = `shell-${VERSION}`;
+const DATA_CACHE = `data-${VERSION}`;
+const IMAGE_CACHE = `images-${VERSION}`;
+const SHELL = [
+  '/',
+  '/gracias',
+  '/static/styles.css',
+  '/static/gf.png',
+  '/static/icon.png',
+  '/static/js/tom-select.min.js',
+  '/static/js/outbox.js',
+];
+// Past this, a page or catalog request falls back to the cached copy
+const NETWORK_TIMEOUT_MS = 3000;
+
+self.addEventListener('install', event => {
+  event.waitUntil(caches.open(SHELL_CACHE).then(cache => cache.addAll(SHELL)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', event => {
+  const keep = [SHELL_CACHE, DATA_CACHE, IMAGE_CACHE];
+  event.waitUntil(
+    caches.keys()
+      .then(names => Promise.all(names.filter(n => !keep.includes(n)).map(n => caches.delete(n))))
+      .then(() => self.clients.claim())
+  );
+});
+
+// Fresh copy when the network answers in time, cached copy otherwise
+function networkFirst(request, cacheName) {
+  return caches.open(cacheName).then(cache => {
+    const network = fetch(request).then(res => {
+      if (res.ok) cache.put(request, res.clone());
+      return res;
+    });
+    const timeout = new Promise(resolve => setTimeout(resolve, NETWORK_TIMEOUT_MS));
+    const fallback = () => cache.match(request, { ignoreVary: true }).then(hit => hit || network);
+    return Promise.race([network, timeout.then(() => null)])
+      .then(res => res || fallback())
+      .catch(fallback);
+  });
+}
+
+// Hashed images never change under a name
+function cacheFirst(request, cacheName) {
+  return caches.open(cacheName).then(cache => cache.match(request, { ignoreVary: true }).then(hit => hit || fetch(request).then(res => {
+    if (res.ok) cache.put(request, res.clone());
+    return res;
+  })));
+}
+
+function staleWhileRevalidate(request, cacheName, key = request) {
+  return caches.open(cacheName).then(cache => cache.match(key, { ignoreVary: true }).then(hit => {
+    const network = fetch(key).then(res => {
+      if (res.ok) cache.put(key, res.clone());
+      return res;
+    });
+    if (hit) {
+      network.catch(() => {});
+      return hit;
+    }
+    return network;
+  }));
+}
+
+self.addEventListener('fetch', event => {
+  const request = event.request;
+  const url = new URL(request.url);
+  if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+
+  if (url.pathname === '/gracias') {
+    // The receipt renders itself from ?receipt=, so checkout needs no request
+    event.respondWith(staleWhileRevalidate(request, SHELL_CACHE, '/gracias'));
+  } else if (url.pathname === '/') {
+    event.respondWith(networkFirst(request, SHELL_CACHE));
+  } else if (url.pathname === '/api/products') {
+    event.respondWith(networkFirst(request, DATA_CACHE));
+  } else if (url.pathname.startsWith('/static/images/')) {
+    event.respondWith(cacheFirst(request, IMAGE_CACHE));
+  } else if (url.pathname.startsWith('/static/')) {
+    event.respondWith(staleWhileRevalidate(request, SHELL_CACHE));
+  }
+});
+
+self.addEventListener('sync', event => {
+  if (event.tag === 'outbox') event.waitUntil(Outbox.flush());
+});
+
+self.addEventListener('message', event => {
+  if (event.data === 'flush-outbox') event.waitUntil(Outbox.flush());
+});
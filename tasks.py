@@ -0,0 +1,49 @@
+"""One background worker thread for slow jobs that must not hold up a request.
+
+Jobs run in submission order, outside any request context, so anything that
+needs the database opens its own connection with db.connect().
+"""
+import logging
+import os
+import queue
+import threading
+
+
+log = logging.getLogger(__name__)
+
+# BOUTIQUE_TASKS=0 drops jobs instead (benchmarks, so no thread competes)
+ENABLED = os.environ.get("BOUTIQUE_TASKS", "1") != "0"
+
+_queue = queue.Queue()
+_lock = threading.Lock()
+_thread = None
+_pid = None
+
+
+def _run():
+    while True:
+        fn, args, kwargs = _queue.get()
+        try:
+            fn(*args, **kwargs)
+        except Exception:
+            log.exception("Background job %s failed", getattr(fn, "__name__", fn))
+        finally:
+            _queue.task_done()
+
+
+def submit(fn, *args, **kwargs):
+    global _thread, _pid
+    if not ENABLED:
+        return
+    with _lock:
+        # Started lazily, and again in a forked worker (threads don't survive fork)
+        if _thread is None or _pid != os.getpid() or not _thread.is_alive():
+            _thread = threading.Thread(target=_run, name="boutique-tasks", daemon=True)
+            _thread.start()
+            _pid = os.getpid()
+    _queue.put((fn, args, kwargs))
+
+
+def join():
+    """Block until every queued job has finished (scripts and benchmarks)."""
+    _queue.join()